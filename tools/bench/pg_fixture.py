@@ -0,0 +1,118 @@
+"""Load the synthetic data into a Postgres schema for the benchmarks.
+
+Creates locations_agg, wikidatamap, wikidata and gendermap with the
+columns osm_add_tags.py reads, filled to match a SyntheticData extract.
+Connection parameters come from the usual PG* environment variables.
+"""
+
+import argparse
+import io
+import json
+
+import psycopg2
+from psycopg2 import sql
+
+from synthetic import GENDERS, SyntheticData
+
+# Objects per locations_agg row, like several OSM ways forming one street
+OBJECTS_PER_LOCATION = 3
+
+TABLES = """
+    DROP TABLE IF EXISTS locations_agg, wikidatamap, wikidata, gendermap;
+    CREATE TABLE locations_agg (
+        id integer PRIMARY KEY,
+        geomtype text NOT NULL,
+        object_ids bigint[] NOT NULL
+    );
+    CREATE TABLE wikidatamap (
+        location_id integer NOT NULL,
+        wikidata_id text NOT NULL
+    );
+    CREATE TABLE wikidata (
+        itemid text PRIMARY KEY,
+        name text,
+        description text,
+        claims jsonb
+    );
+    CREATE TABLE gendermap (
+        itemid text PRIMARY KEY,
+        gender text NOT NULL
+    );
+"""
+
+
+def copy_rows(cur, table, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join("\\N" if value is None else str(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} FROM STDIN", buffer)
+
+
+def location_rows(data):
+    """Yield (location id, geomtype, object ids, QID) grouping objects by QID."""
+    location_id = 0
+    for geomtype, count in (("point", data.nodes), ("line", data.ways)):
+        by_qid = {}
+        for oid in data.etymology_ids(count):
+            by_qid.setdefault(data.qid(oid), []).append(oid)
+        for qid, ids in by_qid.items():
+            for i in range(0, len(ids), OBJECTS_PER_LOCATION):
+                location_id += 1
+                yield location_id, geomtype, ids[i : i + OBJECTS_PER_LOCATION], qid
+
+
+def claims(data, qid):
+    gender_item = data.gender_item(qid)
+    if not gender_item:
+        return {}
+    return {"P21": [{"mainsnak": {"datavalue": {"value": {"id": gender_item}}}}]}
+
+
+def create_fixture(conn, schema, data):
+    """Create and fill the fixture tables in schema; return row counts."""
+    locations = list(location_rows(data))
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(schema)))
+        cur.execute(sql.SQL("SET search_path TO {}, public").format(sql.Identifier(schema)))
+        cur.execute(TABLES)
+        copy_rows(
+            cur,
+            "locations_agg",
+            ((lid, geomtype, "{" + ",".join(map(str, ids)) + "}") for lid, geomtype, ids, _ in locations),
+        )
+        copy_rows(cur, "wikidatamap", ((lid, qid) for lid, _, _, qid in locations))
+        copy_rows(
+            cur,
+            "wikidata",
+            (
+                (qid, f"Person {qid[1:]}", "synthetic description", json.dumps(claims(data, qid)))
+                for qid in data.all_qids()
+            ),
+        )
+        copy_rows(cur, "gendermap", GENDERS.items())
+        cur.execute("CREATE INDEX ON wikidatamap (location_id)")
+        cur.execute("ANALYZE")
+    conn.commit()
+    return {
+        "locations_agg": len(locations),
+        "wikidatamap": len(locations),
+        "wikidata": data.qids,
+        "gendermap": len(GENDERS),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the benchmark tables in Postgres.")
+    parser.add_argument("--schema", default="osmtools_bench")
+    parser.add_argument("--nodes", type=int, default=100000)
+    parser.add_argument("--ways", type=int, default=20000)
+    parser.add_argument("--density", type=float, default=0.1)
+    parser.add_argument("--qids", type=int, default=5000)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect("")
+    counts = create_fixture(conn, args.schema, SyntheticData(args.nodes, args.ways, args.density, args.qids))
+    conn.close()
+    print(json.dumps(counts))
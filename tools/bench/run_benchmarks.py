@@ -0,0 +1,299 @@
+"""Benchmark the osmtools scripts on synthetic data and local services.
+
+Writes a synthetic extract (see synthetic.py), starts the fake SPARQL
+endpoint and OSM API in-process, and runs each benchmark in a fresh
+process, so the peak RSS reported is that benchmark's own. With
+--postgres, the data is also loaded into a Postgres schema (see
+pg_fixture.py) and the database queries are part of the timings.
+
+The report is JSON with seconds, objects per second and peak RSS per
+benchmark. With --baseline, the exit status is 1 if any benchmark is
+slower or uses more memory than the baseline report by more than
+--tolerance.
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from argparse import Namespace
+from datetime import datetime, timezone
+from queue import Empty
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "mock"))
+sys.path.insert(0, TOOLS_DIR)
+
+from synthetic import SyntheticData  # noqa: E402
+
+# How often a benchmark process that has not reported is checked for an exit
+POLL_SECONDS = 1
+
+
+def connect(schema):
+    import psycopg2
+    from psycopg2 import sql
+
+    conn = psycopg2.connect("")
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SET search_path TO {}, public").format(sql.Identifier(schema)))
+    return conn
+
+
+def bench_update_osm_tags(ctx):
+    import osm_add_tags
+
+    data = SyntheticData(**ctx["data"])
+    result = {}
+    if ctx["schema"]:
+        conn = connect(ctx["schema"])
+        start = time.perf_counter()
+        node_genders, way_genders = osm_add_tags.get_all_osm_ids_with_gender_from_db(conn)
+        result["db_seconds"] = time.perf_counter() - start
+        conn.close()
+    else:
+        node_genders = osm_add_tags.GenderIndex(data.genders(data.nodes).items())
+        way_genders = osm_add_tags.GenderIndex(data.genders(data.ways).items())
+    output = os.path.join(ctx["work_dir"], "update_osm_tags.osm.pbf")
+    if os.path.exists(output):
+        os.remove(output)
+    osm_add_tags.update_osm_tags(ctx["pbf"], node_genders, way_genders, output)
+    result["objects"] = data.nodes + data.ways
+    return result
+
+
+def bench_update_osm_names_from_description(ctx):
+    import osm_add_tags
+
+    data = SyntheticData(**ctx["data"])
+    result = {}
+    if ctx["schema"]:
+        conn = connect(ctx["schema"])
+        start = time.perf_counter()
+        descriptions = osm_add_tags.get_all_wikidata_descriptions(conn)
+        result["db_seconds"] = time.perf_counter() - start
+        conn.close()
+    else:
+        descriptions = data.descriptions()
+    output = os.path.join(ctx["work_dir"], "update_names.osm.pbf")
+    if os.path.exists(output):
+        os.remove(output)
+    osm_add_tags.update_osm_names_from_description(ctx["pbf"], descriptions, output)
+    result["objects"] = data.nodes + data.ways
+    return result
+
+
+def bench_sparql_step2(ctx):
+    import logging
+
+    import wikidata_etymology_to_osm as wd
+    from wikidata_cache import NamedAfterCache
+
+    logging.getLogger().setLevel(logging.WARNING)
+    work_dir = os.path.join(ctx["work_dir"], "sparql")
+    os.makedirs(work_dir, exist_ok=True)
+    files = wd.checkpoint_files(work_dir, "bench")
+    wd.stage_scan(ctx["pbf"], files)
+    cache_file = os.path.join(work_dir, "cache.sqlite")
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    cache = NamedAfterCache(cache_file)
+    args = Namespace(
+        cache_ttl_days=30, dump=None, endpoint=ctx["sparql_url"], concurrency=4, rate=ctx["sparql_rate"]
+    )
+    # Only the query stage is timed by the caller from here on
+    start = time.perf_counter()
+    wd.stage_query(files, cache, args)
+    seconds = time.perf_counter() - start
+    objects = len(cache)
+    cache.close()
+    return {"objects": objects, "timed_seconds": seconds}
+
+
+def bench_stage2_fetch_contributors(ctx):
+    import get_etymology_contributors as contributors
+
+    data = SyntheticData(**ctx["data"])
+    work_dir = os.path.join(ctx["work_dir"], "contributors")
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    if os.path.exists(contributors.CACHE_CONTRIBUTORS_FILE):
+        os.remove(contributors.CACHE_CONTRIBUTORS_FILE)
+    objects = [("node", str(oid)) for oid in data.etymology_ids(data.nodes)[: ctx["history_objects"]]]
+    found = contributors.stage2_fetch_contributors(
+        objects, use_cache=False, api_url=ctx["osm_api_url"], workers=4, rate=ctx["osm_api_rate"]
+    )
+    return {"objects": len(objects), "contributors": len(found)}
+
+
+BENCHMARKS = {
+    "update_osm_tags": bench_update_osm_tags,
+    "update_osm_names_from_description": bench_update_osm_names_from_description,
+    "sparql_step2": bench_sparql_step2,
+    "stage2_fetch_contributors": bench_stage2_fetch_contributors,
+}
+
+
+def run_one(name, ctx, queue):
+    """Run one benchmark in this (child) process and report through queue."""
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            result = BENCHMARKS[name](ctx)
+            seconds = result.pop("timed_seconds", time.perf_counter() - start)
+        result["seconds"] = round(seconds, 3)
+        result["objects_per_second"] = round(result["objects"] / seconds, 1) if seconds else None
+        # ru_maxrss is in kilobytes on Linux
+        result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        if "db_seconds" in result:
+            result["db_seconds"] = round(result["db_seconds"], 3)
+        queue.put((name, result))
+    except Exception as e:
+        queue.put((name, {"error": f"{type(e).__name__}: {e}"}))
+
+
+def run_isolated(name, ctx):
+    """Run one benchmark in a fresh process and return its result.
+
+    A process that exits without a result, e.g. one killed by the OOM
+    killer, is recorded as an error instead of blocking the run.
+    """
+    spawn = multiprocessing.get_context("spawn")
+    queue = spawn.Queue()
+    process = spawn.Process(target=run_one, args=(name, ctx, queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            _, result = queue.get(timeout=POLL_SECONDS)
+        except Empty:
+            if process.exitcode is None:
+                continue
+            # A result put just before exiting is already in the pipe
+            try:
+                _, result = queue.get_nowait()
+            except Empty:
+                result = {"error": f"process exited with code {process.exitcode}"}
+    process.join()
+    return result
+
+
+def compare(report, baseline, tolerance):
+    """Return a list of regressions of report against baseline."""
+    regressions = []
+    for name, result in report["benchmarks"].items():
+        base = baseline.get("benchmarks", {}).get(name)
+        if not base or "error" in base:
+            continue
+        if "error" in result:
+            regressions.append(f"{name}: failed ({result['error']})")
+            continue
+        if result["objects_per_second"] < base["objects_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['objects_per_second']} objects/s, baseline {base['objects_per_second']}"
+            )
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']} MB, baseline {base['peak_rss_mb']} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--work-dir", default="bench_work", help="Directory for generated files")
+    parser.add_argument("--report", help="Write the JSON report here as well as to stdout")
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--nodes", type=int, default=200000)
+    parser.add_argument("--ways", type=int, default=50000)
+    parser.add_argument("--density", type=float, default=0.1, help="Share of objects with etymology tags")
+    parser.add_argument("--qids", type=int, default=5000, help="Distinct Wikidata items")
+    parser.add_argument(
+        "--history-objects", type=int, default=2000, help="Objects to fetch histories for (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--postgres",
+        metavar="SCHEMA",
+        help="Load the fixture into this Postgres schema (PG* environment variables) and read from it",
+    )
+    parser.add_argument("--baseline", help="Earlier report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression (default: 0.2)")
+    args = parser.parse_args()
+
+    from osm_api import start_server as start_osm_api
+    from sparql_endpoint import start_server as start_sparql
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    work_dir = os.path.abspath(args.work_dir)
+    data = SyntheticData(args.nodes, args.ways, args.density, args.qids)
+    pbf = os.path.join(work_dir, "synthetic.osm.pbf")
+    start = time.perf_counter()
+    data.write_pbf(pbf)
+    setup = {"pbf_seconds": round(time.perf_counter() - start, 3), "pbf_bytes": os.path.getsize(pbf)}
+
+    if args.postgres:
+        import psycopg2
+
+        from pg_fixture import create_fixture
+
+        conn = psycopg2.connect("")
+        start = time.perf_counter()
+        setup["postgres_rows"] = create_fixture(conn, args.postgres, data)
+        setup["postgres_seconds"] = round(time.perf_counter() - start, 3)
+        conn.close()
+
+    # The services are generous: the benchmarks measure the clients, not
+    # the rate limits, which tools/mock/check_sparql_client.py covers
+    sparql = start_sparql(max_concurrent=5, rate=100, delay=0.02)
+    osm_api = start_osm_api(max_concurrent=8, rate=1000, delay=0.002)
+    ctx = {
+        "data": data.config(),
+        "pbf": pbf,
+        "work_dir": work_dir,
+        "schema": args.postgres,
+        "sparql_url": sparql.url(),
+        "sparql_rate": 50.0,
+        "osm_api_url": osm_api.url(),
+        "osm_api_rate": 500.0,
+        "history_objects": args.history_objects,
+    }
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "data": data.config(),
+        "setup": setup,
+        "benchmarks": {},
+    }
+    for name in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        print(f"Running {name}...", file=sys.stderr)
+        report["benchmarks"][name] = run_isolated(name, ctx)
+    report["services"] = {"sparql": sparql.stats, "osm_api": osm_api.stats}
+    sparql.shutdown()
+    osm_api.shutdown()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+    failed = [name for name, result in report["benchmarks"].items() if "error" in result]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+    sys.exit(1 if failed or regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
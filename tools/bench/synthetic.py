@@ -0,0 +1,132 @@
+"""Deterministic synthetic OSM data for the benchmarks.
+
+Every rule that decides which objects carry etymology tags, which QIDs they
+point at and which gender a QID has lives here, so the PBF generator, the
+Postgres fixture and the mock services all agree on the same data.
+"""
+
+import argparse
+import os
+
+import osmium
+
+FIRST_QID = 1000
+WAY_NODES = 4
+
+# gendermap rows: P21 value -> gender
+GENDERS = {
+    "Q6581097": "male",
+    "Q6581072": "female",
+    "Q48270": "non-binary",
+}
+
+
+class SyntheticData:
+    """Describes a synthetic extract.
+
+    nodes and ways are object counts, density is the share of them with
+    name:etymology:wikidata (an equal share gets only a wikidata tag) and
+    qids is the number of distinct Wikidata items they point at.
+    """
+
+    def __init__(self, nodes=100000, ways=20000, density=0.1, qids=5000):
+        self.nodes = nodes
+        self.ways = ways
+        self.density = density
+        self.qids = qids
+        self.step = max(1, round(1 / density)) if density > 0 else 0
+
+    def config(self):
+        return {"nodes": self.nodes, "ways": self.ways, "density": self.density, "qids": self.qids}
+
+    def has_etymology(self, oid):
+        return self.step > 0 and oid % self.step == 0
+
+    def has_wikidata(self, oid):
+        return self.step > 1 and oid % self.step == self.step // 2
+
+    def qid(self, oid):
+        return f"Q{FIRST_QID + (oid // max(1, self.step)) % self.qids}"
+
+    def all_qids(self):
+        return [f"Q{n}" for n in range(FIRST_QID, FIRST_QID + self.qids)]
+
+    def node_tags(self, oid):
+        if self.has_etymology(oid):
+            return {"name": f"Place {oid}", "name:etymology:wikidata": self.qid(oid)}
+        if self.has_wikidata(oid):
+            return {"name": f"Place {oid}", "wikidata": self.qid(oid)}
+        return {}
+
+    def way_tags(self, oid):
+        tags = {"highway": "residential", "name": f"Street {oid}"}
+        if self.has_etymology(oid):
+            tags["name:etymology:wikidata"] = self.qid(oid)
+        elif self.has_wikidata(oid):
+            tags["wikidata"] = self.qid(oid)
+        return tags
+
+    def way_nodes(self, oid):
+        first = (oid * WAY_NODES) % max(1, self.nodes - WAY_NODES) + 1
+        return list(range(first, first + WAY_NODES))
+
+    def etymology_ids(self, count):
+        return [oid for oid in range(1, count + 1) if self.has_etymology(oid)]
+
+    @staticmethod
+    def gender_item(qid):
+        """Return the P21 item of a synthetic QID, or None for no P21."""
+        n = int(qid[1:])
+        return {0: "Q6581097", 1: "Q6581072", 3: "Q48270"}.get(n % 4)
+
+    def gender(self, qid):
+        return GENDERS.get(self.gender_item(qid))
+
+    def genders(self, count):
+        """Return {id: gender} for the ids in 1..count that have one."""
+        result = {}
+        for oid in self.etymology_ids(count):
+            gender = self.gender(self.qid(oid))
+            if gender:
+                result[oid] = gender
+        return result
+
+    @staticmethod
+    def description(qid):
+        return f"Person {qid[1:]}; synthetic description"
+
+    def descriptions(self):
+        return {qid: self.description(qid) for qid in self.all_qids()}
+
+    def write_pbf(self, path):
+        """Write the extract to path and return the number of objects."""
+        if os.path.exists(path):
+            os.remove(path)
+        writer = osmium.SimpleWriter(path)
+        try:
+            for oid in range(1, self.nodes + 1):
+                location = ((oid % 1000) * 0.001 + 10.0, (oid // 1000) * 0.001 + 55.0)
+                writer.add_node(
+                    osmium.osm.mutable.Node(id=oid, version=1, location=location, tags=self.node_tags(oid))
+                )
+            for oid in range(1, self.ways + 1):
+                writer.add_way(
+                    osmium.osm.mutable.Way(id=oid, version=1, nodes=self.way_nodes(oid), tags=self.way_tags(oid))
+                )
+        finally:
+            writer.close()
+        return self.nodes + self.ways
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic OSM extract.")
+    parser.add_argument("output", help="Output file, e.g. synthetic.osm.pbf")
+    parser.add_argument("--nodes", type=int, default=100000)
+    parser.add_argument("--ways", type=int, default=20000)
+    parser.add_argument("--density", type=float, default=0.1, help="Share of objects with etymology tags")
+    parser.add_argument("--qids", type=int, default=5000, help="Distinct Wikidata items")
+    args = parser.parse_args()
+
+    data = SyntheticData(args.nodes, args.ways, args.density, args.qids)
+    count = data.write_pbf(args.output)
+    print(f"Wrote {count} objects to {args.output}")
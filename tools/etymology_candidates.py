@@ -0,0 +1,154 @@
+import argparse
+import logging
+import os
+import sqlite3
+
+import osmium
+
+from metrics import METRICS, start_reporting
+
+# Tags the tools look at; objects without any of them are not stored
+CANDIDATE_KEYS = ("wikidata", "name:etymology:wikidata", "name:etymology", "subject:wikidata")
+COLUMNS = ["name", "wikidata", "name_etymology_wikidata", "name_etymology", "subject_wikidata"]
+TYPE_ORDER = "CASE type WHEN 'node' THEN 0 WHEN 'way' THEN 1 ELSE 2 END, id"
+BATCH_SIZE = 10000
+
+
+def default_output(osm_file):
+    name = osm_file
+    for suffix in (".osm.pbf", ".pbf", ".osm.bz2", ".osm"):
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+    return f"{name}.candidates.sqlite"
+
+
+def centroid(obj):
+    """Return the (lon, lat) centroid of a node or the mean of a way's nodes."""
+    if isinstance(obj, osmium.osm.Node):
+        if obj.location.valid():
+            return obj.location.lon, obj.location.lat
+        return None, None
+    if isinstance(obj, osmium.osm.Way):
+        locations = [n.location for n in obj.nodes if n.location.valid()]
+        if locations:
+            return (
+                sum(l.lon for l in locations) / len(locations),
+                sum(l.lat for l in locations) / len(locations),
+            )
+    return None, None
+
+
+def scan(osm_file, output, centroids=False):
+    """Write every object of osm_file with a candidate tag to output.
+
+    The file is decoded once, and osmium drops objects without any of
+    CANDIDATE_KEYS before they reach Python. Way centroids need node
+    locations, so they make the scan slower and are off by default.
+    Returns the number of objects written.
+    """
+    tmp_output = f"{output}.tmp"
+    if os.path.exists(tmp_output):
+        os.remove(tmp_output)
+    conn = sqlite3.connect(tmp_output)
+    conn.execute(
+        """
+        CREATE TABLE candidates (
+            type TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            name TEXT,
+            wikidata TEXT,
+            name_etymology_wikidata TEXT,
+            name_etymology TEXT,
+            subject_wikidata TEXT,
+            lon REAL,
+            lat REAL,
+            PRIMARY KEY (type, id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    processor = osmium.FileProcessor(osm_file).with_filter(osmium.filter.KeyFilter(*CANDIDATE_KEYS))
+    if centroids:
+        processor = processor.with_locations()
+    type_names = {"n": "node", "w": "way", "r": "relation"}
+    insert = f"INSERT INTO candidates VALUES (?, ?, {', '.join('?' for _ in COLUMNS)}, ?, ?)"
+    rows = []
+    count = 0
+    for obj in METRICS.count_objects(processor, "candidates"):
+        tags = obj.tags
+        lon, lat = centroid(obj) if centroids else (None, None)
+        rows.append(
+            (type_names[obj.type_str()], obj.id, tags.get("name"))
+            + tuple(tags.get(key) for key in CANDIDATE_KEYS)
+            + (lon, lat)
+        )
+        if len(rows) >= BATCH_SIZE:
+            conn.executemany(insert, rows)
+            count += len(rows)
+            rows = []
+            logging.info(f"Stored {count} candidates so far.")
+    conn.executemany(insert, rows)
+    count += len(rows)
+
+    conn.execute("CREATE INDEX candidates_wikidata ON candidates (wikidata)")
+    conn.execute("CREATE INDEX candidates_name_etymology_wikidata ON candidates (name_etymology_wikidata)")
+    stat = os.stat(osm_file)
+    METRICS.inc("input_bytes_total", stat.st_size, source="candidates")
+    conn.executemany(
+        "INSERT INTO meta VALUES (?, ?)",
+        [
+            ("input", os.path.abspath(osm_file)),
+            ("size", str(stat.st_size)),
+            ("mtime", str(stat.st_mtime)),
+            ("centroids", "1" if centroids else "0"),
+        ],
+    )
+    conn.commit()
+    conn.close()
+    os.replace(tmp_output, output)
+    return count
+
+
+def read_meta(path):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return dict(conn.execute("SELECT key, value FROM meta"))
+    finally:
+        conn.close()
+
+
+def iter_candidates(path, where="1", limit=None):
+    """Yield candidate rows as dicts in file order (nodes, ways, relations).
+
+    where is an SQL condition on the candidates columns, e.g.
+    "name_etymology_wikidata IS NOT NULL".
+    """
+    query = f"SELECT type, id, {', '.join(COLUMNS)}, lon, lat FROM candidates WHERE {where} ORDER BY {TYPE_ORDER}"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        for row in conn.execute(query):
+            yield dict(row)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(
+        description="Scan an OSM file once for objects with wikidata or etymology tags."
+    )
+    parser.add_argument("osm_file", help="Input OSM or PBF file")
+    parser.add_argument("output", nargs="?", help="Candidates file (default: <input>.candidates.sqlite)")
+    parser.add_argument("--centroids", action="store_true", help="Store node locations and way centroids")
+    args = parser.parse_args()
+
+    start_reporting("etymology_candidates")
+    output = args.output or default_output(args.osm_file)
+    logging.info(f"Scanning {args.osm_file}...")
+    count = scan(args.osm_file, output, centroids=args.centroids)
+    logging.info(f"Wrote {count} candidates to {output}.")
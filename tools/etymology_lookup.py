@@ -0,0 +1,211 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+from metrics import METRICS, start_reporting
+
+# One row per OSM object and Wikidata item it is named after
+LOOKUP_TABLE = "osm_etymology"
+# The gender and description of every item as of the last refresh
+ITEMS_TABLE = "osm_etymology_items"
+# OSM objects whose rows were rebuilt by a refresh, until osm_add_tags.py
+# --changes has re-checked them
+CHANGES_TABLE = "osm_etymology_changes"
+
+TABLES = f"""
+    CREATE TABLE IF NOT EXISTS {LOOKUP_TABLE} (
+        osm_type char(1) NOT NULL,
+        osm_id bigint NOT NULL,
+        wikidata_id text NOT NULL,
+        gender text,
+        description text,
+        PRIMARY KEY (osm_type, osm_id, wikidata_id)
+    );
+    CREATE INDEX IF NOT EXISTS {LOOKUP_TABLE}_wikidata_id ON {LOOKUP_TABLE} (wikidata_id);
+    CREATE TABLE IF NOT EXISTS {ITEMS_TABLE} (
+        wikidata_id text PRIMARY KEY,
+        gender text,
+        description text
+    );
+    CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} (
+        osm_type char(1) NOT NULL,
+        osm_id bigint NOT NULL,
+        PRIMARY KEY (osm_type, osm_id)
+    );
+"""
+
+# Records the objects of the changed items in CHANGES_TABLE
+RECORD_CHANGES = f"""
+    INSERT INTO {CHANGES_TABLE} (osm_type, osm_id)
+    SELECT t.osm_type, t.osm_id
+      FROM {LOOKUP_TABLE} t
+      JOIN changed_items c ON c.wikidata_id = t.wikidata_id
+    ON CONFLICT DO NOTHING
+"""
+
+# Gender and description of every item, as osm_add_tags.py derives them
+# in its export queries. Items with several P21 claims have their genders
+# joined with ";".
+CURRENT_ITEMS = """
+    SELECT w.itemid AS wikidata_id,
+           (SELECT string_agg(DISTINCT g.gender, ';' ORDER BY g.gender)
+              FROM jsonb_array_elements(
+                       CASE jsonb_typeof(w.claims->'P21') WHEN 'array' THEN w.claims->'P21' END
+                   ) AS p21(claim)
+              JOIN gendermap g ON (p21.claim->'mainsnak'->'datavalue'->'value'->>'id') = g.itemid
+           ) AS gender,
+           CASE WHEN w.description IS NOT NULL
+                THEN COALESCE(w.name || '; ' || w.description, w.name)
+           END AS description
+      FROM wikidata w
+"""
+
+
+def create_tables(conn):
+    with conn.cursor() as cur:
+        cur.execute(TABLES)
+    conn.commit()
+
+
+def refresh(conn, full=False):
+    """Bring the lookup table up to date with the Wikidata tables.
+
+    Only the items whose gender or description changed since the last
+    refresh, and items that were added or removed, have their rows
+    deleted and rebuilt from locations_agg and wikidatamap. With full,
+    every item is rebuilt, which is needed after the locations were
+    reloaded. Everything happens in one transaction, so readers see
+    either the old or the new table. Returns (changed items, rows written).
+
+    The objects of the changed items, before and after the refresh, are
+    added to the changes table, which claim_changes empties.
+    """
+    create_tables(conn)
+    with conn.cursor() as cur:
+        if full:
+            cur.execute(
+                f"""
+                INSERT INTO {CHANGES_TABLE} (osm_type, osm_id)
+                SELECT DISTINCT osm_type, osm_id FROM {LOOKUP_TABLE}
+                ON CONFLICT DO NOTHING
+                """
+            )
+            cur.execute(f"TRUNCATE {LOOKUP_TABLE}, {ITEMS_TABLE}")
+        cur.execute(
+            f"""
+            CREATE TEMPORARY TABLE changed_items ON COMMIT DROP AS
+            SELECT wikidata_id FROM (
+                {CURRENT_ITEMS}
+                EXCEPT
+                SELECT wikidata_id, gender, description FROM {ITEMS_TABLE}
+            ) added_or_changed
+            UNION
+            SELECT i.wikidata_id
+              FROM {ITEMS_TABLE} i
+             WHERE NOT EXISTS (SELECT 1 FROM wikidata w WHERE w.itemid = i.wikidata_id)
+            """
+        )
+        cur.execute("ALTER TABLE changed_items ADD PRIMARY KEY (wikidata_id)")
+        cur.execute("ANALYZE changed_items")
+        cur.execute("SELECT COUNT(*) FROM changed_items")
+        (changed,) = cur.fetchone()
+        logging.info(f"{changed} Wikidata items changed since the last refresh.")
+
+        cur.execute(RECORD_CHANGES)
+        cur.execute(
+            f"DELETE FROM {LOOKUP_TABLE} t USING changed_items c WHERE t.wikidata_id = c.wikidata_id"
+        )
+        cur.execute(
+            f"DELETE FROM {ITEMS_TABLE} t USING changed_items c WHERE t.wikidata_id = c.wikidata_id"
+        )
+        cur.execute(
+            f"""
+            INSERT INTO {ITEMS_TABLE}
+            SELECT i.* FROM ({CURRENT_ITEMS}) i
+              JOIN changed_items c ON c.wikidata_id = i.wikidata_id
+            """
+        )
+        # Points are nodes; lines and polygons are ways, as in the exports
+        cur.execute(
+            f"""
+            INSERT INTO {LOOKUP_TABLE} (osm_type, osm_id, wikidata_id, gender, description)
+            SELECT CASE WHEN l.geomtype = 'point' THEN 'n' ELSE 'w' END,
+                   o.osm_id,
+                   i.wikidata_id,
+                   i.gender,
+                   i.description
+              FROM changed_items c
+              JOIN {ITEMS_TABLE} i ON i.wikidata_id = c.wikidata_id
+              JOIN wikidatamap map ON map.wikidata_id = i.wikidata_id
+              JOIN locations_agg l ON l.id = map.location_id
+             CROSS JOIN LATERAL UNNEST(l.object_ids) AS o(osm_id)
+             WHERE l.geomtype IN ('point', 'line', 'polygon')
+               AND o.osm_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+            """
+        )
+        rows = cur.rowcount
+        METRICS.inc("db_rows_total", rows, query="lookup_refresh")
+        cur.execute(RECORD_CHANGES)
+    conn.commit()
+    if changed:
+        with conn.cursor() as cur:
+            cur.execute(f"ANALYZE {LOOKUP_TABLE}, {ITEMS_TABLE}")
+        conn.commit()
+    return changed, rows
+
+
+def claim_changes(conn):
+    """Remove and return the objects recorded by refresh as {"n": ids, "w": ids}.
+
+    The rows are deleted in the current transaction, so they are only gone
+    once the caller commits, i.e. after it has used them.
+    """
+    changes = {"n": set(), "w": set()}
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM {CHANGES_TABLE} RETURNING osm_type, osm_id")
+        for osm_type, osm_id in cur:
+            changes[osm_type].add(osm_id)
+    return changes
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(
+        description="Build or refresh the OSM object -> gender/description lookup table in Postgres."
+    )
+    parser.add_argument("schema", help="Postgres schema to use")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Rebuild the whole table, e.g. after locations_agg or wikidatamap were reloaded. "
+        "By default only rows of Wikidata items that changed since the last refresh are rebuilt",
+    )
+    args = parser.parse_args()
+
+    # Read DB params from environment
+    db_params = {
+        "dbname": os.environ.get("PGDATABASE"),
+        "user": os.environ.get("PGUSER"),
+        "password": os.environ.get("PGPASSWORD"),
+        "host": os.environ.get("PGHOST", "localhost"),
+        "port": int(os.environ.get("PGPORT", 5432)),
+    }
+    missing = [name for name in ("PGDATABASE", "PGUSER", "PGPASSWORD") if not os.environ.get(name)]
+    if missing:
+        print(f"Missing required environment variables: {', '.join(missing)}")
+        sys.exit(1)
+
+    start_reporting("etymology_lookup")
+    conn = psycopg2.connect(**db_params)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SET search_path TO {}, public").format(sql.Identifier(args.schema)))
+    start = time.perf_counter()
+    changed, rows = refresh(conn, full=args.full)
+    conn.close()
+    logging.info(f"Rebuilt {changed} items with {rows} rows in {time.perf_counter() - start:.1f} s.")
@@ -3,10 +3,32 @@ import argparse
 import requests
 import time
 import os
+import io
+import csv
+import json
+import threading
 import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import groupby, islice
+from operator import itemgetter
+
+import etymology_candidates
+from metrics import METRICS, start_reporting
+from ratelimit import RateLimiter, request_with_retries
 
 CACHE_OBJECTS_FILE = "etymology_objects_cache.txt"
 CACHE_CONTRIBUTORS_FILE = "etymology_contributors_cache.txt"
+STATS_JSON_FILE = "etymology_contributors_stats.json"
+STATS_CSV_FILE = "etymology_contributors_stats.csv"
+# Progress file and statistics of a --no-cache run, which cover only that
+# run's objects
+RUN_CONTRIBUTORS_FILE = "etymology_contributors_run_cache.txt"
+RUN_STATS_JSON_FILE = "etymology_contributors_run_stats.json"
+RUN_STATS_CSV_FILE = "etymology_contributors_run_stats.csv"
+STATS_FIELDS = ["uid", "user", "objects", "node", "way", "relation", "first_contribution"]
+OSM_API_URL = "https://api.openstreetmap.org/api/0.6"
+OSM_TYPES = {'n': 'node', 'w': 'way', 'r': 'relation'}
+USER_AGENT = "FindvejEtymologyBot/1.0 (https://navne.findvej.dk/;peter@ter.dk)"
 
 class EtymologyHandler(osmium.SimpleHandler):
     def __init__(self):
@@ -25,88 +47,415 @@ class EtymologyHandler(osmium.SimpleHandler):
         if 'name:etymology:wikidata' in r.tags:
             self.objects.append(('relation', r.id))
 
-def stage1_find_objects(pbf_file, use_cache=True):
+def stage1_find_objects(pbf_file, use_cache=True, candidates=None):
     if use_cache and os.path.exists(CACHE_OBJECTS_FILE):
         print("Using cached objects file.")
         with open(CACHE_OBJECTS_FILE, "r", encoding="utf-8") as f:
             objects = [tuple(line.strip().split(',')) for line in f if line.strip()]
         return objects
+    if candidates:
+        print(f"Reading objects with name:etymology:wikidata from {candidates}...")
+        objects = [
+            (elem['type'], elem['id'])
+            for elem in etymology_candidates.iter_candidates(candidates, "name_etymology_wikidata IS NOT NULL")
+        ]
+        with open(CACHE_OBJECTS_FILE, "w", encoding="utf-8") as f:
+            for obj_type, obj_id in objects:
+                f.write(f"{obj_type},{obj_id}\n")
+        return objects
     print("Scanning .pbf file for objects with name:etymology:wikidata...")
     handler = EtymologyHandler()
     handler.apply_file(pbf_file)
+    METRICS.inc("input_bytes_total", os.path.getsize(pbf_file), source="contributors_scan")
+    METRICS.inc("candidates_total", len(handler.objects), source="contributors_scan")
     with open(CACHE_OBJECTS_FILE, "w", encoding="utf-8") as f:
         for obj_type, obj_id in handler.objects:
             f.write(f"{obj_type},{obj_id}\n")
     return handler.objects
 
-def stage2_fetch_contributors(objects, use_cache=True):
+def etymology_contributors(versions):
+    """Return (user, uid, timestamp) for each user that added an etymology tag.
+
+    versions yields (tag keys, user, uid, timestamp) for each version of one
+    object, oldest first. timestamp is the user's first such version.
+    """
+    seen_users = []
+    had_etymology = False
+    for keys, user, uid, timestamp in versions:
+        has_etymology = ('name:etymology:wikidata' in keys or 'name:etymology' in keys)
+        if has_etymology and not had_etymology:
+            if user and uid and not any(seen[:2] == (user, uid) for seen in seen_users):
+                seen_users.append((user, uid, timestamp))
+        had_etymology = has_etymology
+    return seen_users
+
+def iter_history_versions(obj_type, content):
+    """Yield (tag keys, user, uid, timestamp) for each version in a /history response.
+
+    Only tag keys and user attributes are kept, and each version element is
+    dropped from the tree as soon as the next one starts.
+    """
+    keys = None
+    events = ET.iterparse(io.BytesIO(content), events=("start",))
+    _, root = next(events)
+    for _, elem in events:
+        if elem.tag == obj_type:
+            if keys is not None:
+                yield keys, user, uid, timestamp
+            keys = set()
+            user = elem.get('user')
+            uid = elem.get('uid')
+            timestamp = elem.get('timestamp')
+            root.clear()
+        elif elem.tag == 'tag' and keys is not None:
+            keys.add(elem.get('k'))
+    if keys is not None:
+        yield keys, user, uid, timestamp
+
+def parse_history(obj_type, content):
+    """Return (user, uid, timestamp) for each user that added an etymology tag."""
+    return etymology_contributors(iter_history_versions(obj_type, content))
+
+class ProgressLog:
+    """Buffered writer for the contributors cache file.
+
+    Every processed object is recorded: one "type,id,user,uid,timestamp"
+    line per contributor, or a "type,id" line when it has none, so a resumed run
+    skips it either way. Lines are written every flush_every objects or
+    flush_interval seconds, whichever comes first. Without append, the
+    file is emptied first.
+    """
+
+    def __init__(self, path, append=True, flush_every=500, flush_interval=10):
+        self.file = open(path, "a" if append else "w", encoding="utf-8")
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+
+    def record(self, obj_type, obj_id, users):
+        METRICS.inc("objects_done_total", type=obj_type)
+        if users:
+            self.buffer.extend(
+                f"{obj_type},{obj_id},{user},{uid},{timestamp or ''}\n" for user, uid, timestamp in users
+            )
+        else:
+            self.buffer.append(f"{obj_type},{obj_id}\n")
+        self.pending += 1
+        if self.pending >= self.flush_every or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.file.write("".join(self.buffer))
+        self.file.flush()
+        self.buffer = []
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class HistoryFetcher:
+    """Fetches object histories from several threads under a shared rate limit.
+
+    HTTP 429 and 5xx answers pause all threads for the Retry-After delay (or
+    an exponential backoff) and lower the request rate.
+    """
+
+    def __init__(self, api_url=OSM_API_URL, rate=2.0, max_retries=5, timeout=60):
+        self.api_url = api_url.rstrip('/')
+        self.headers = {"User-Agent": USER_AGENT}
+        self.limiter = RateLimiter(rate)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def fetch(self, obj_type, obj_id):
+        """Return the history XML, b"" for deleted objects, or None on failure."""
+        url = f"{self.api_url}/{obj_type}/{obj_id}/history"
+        try:
+            resp = request_with_retries(
+                lambda: self._session().get(url, headers=self.headers, timeout=self.timeout),
+                url,
+                "osm_api",
+                self.limiter,
+                self.max_retries,
+                log=print,
+            )
+        except requests.RequestException as e:
+            print(f"Giving up on {url} after {self.max_retries} retries: {e}")
+            METRICS.inc("http_failed_total", service="osm_api")
+            return None
+        if resp.status_code in (404, 410):
+            return b""
+        if resp.status_code != 200:
+            print(f"Error fetching {url}: HTTP {resp.status_code}")
+            METRICS.inc("http_failed_total", service="osm_api")
+            return None
+        return resp.content
+
+def parse_cache_line(line):
+    """Return (type, id, user, uid, timestamp) from a contributors cache line.
+
+    user and uid are None for objects without contributors, and timestamp
+    is None for lines written before timestamps were recorded. Returns None
+    for lines that cannot be parsed.
+    """
+    parts = line.strip().split(',')
+    if len(parts) == 2:
+        return parts[0], parts[1], None, None, None
+    if len(parts) == 4:
+        return (*parts, None)
+    if len(parts) == 5:
+        return (*parts[:4], parts[4] or None)
+    return None
+
+def read_contributors_cache(use_cache=True):
     contributors = set()
     already_done = set()
-    already_done_count = 0
     if use_cache and os.path.exists(CACHE_CONTRIBUTORS_FILE):
         print("Using cached contributors file.")
         with open(CACHE_CONTRIBUTORS_FILE, "r", encoding="utf-8") as f:
             for line in f:
-                parts = line.strip().split(',')
-                if len(parts) == 4:
-                    already_done.add((parts[0], parts[1]))
-                    contributors.add(tuple(parts))
-        already_done_count = len(already_done)
-    session = requests.Session()
-    requests_made = already_done_count
-    total_count = len(objects)
-    for idx, (obj_type, obj_id) in enumerate(objects, 1):
-        if (obj_type, obj_id) in already_done:
-            continue
-        if requests_made % 50 == 0 and requests_made > 0:
-            print(f"Requesting history file {requests_made} out of {total_count}")
-        url = f"https://api.openstreetmap.org/api/0.6/{obj_type}/{obj_id}/history"
-        while True:
-            try:
-                resp = session.get(url)
-                if resp.status_code == 429:
-                    print("Rate limited, sleeping for 5 seconds...")
-                    time.sleep(5)
+                record = parse_cache_line(line)
+                if record is None:
                     continue
-                resp.raise_for_status()
-                break
-            except requests.RequestException as e:
-                print(f"Error fetching {url}: {e}")
-                time.sleep(5)
-        requests_made += 1
-        # if requests_made % 100 == 0:
-        #     time.sleep(1)
-        root = ET.fromstring(resp.content)
-        seen_users = set()
-        prev_tags = set()
-        for elem in root.findall(obj_type):
-            tags = {tag.attrib['k']: tag.attrib['v'] for tag in elem.findall('tag')}
-            has_etymology = ('name:etymology:wikidata' in tags or 'name:etymology' in tags)
-            had_etymology = ('name:etymology:wikidata' in prev_tags or 'name:etymology' in prev_tags)
-            if has_etymology and not had_etymology:
-                user = elem.attrib.get('user')
-                uid = elem.attrib.get('uid')
-                if user and uid and (user, uid) not in seen_users:
-                    contributors.add((obj_type, obj_id, user, uid))
-                    seen_users.add((user, uid))
-            prev_tags = set(tags.keys())
-        # Append new contributors to cache file
-        with open(CACHE_CONTRIBUTORS_FILE, "a", encoding="utf-8") as f:
-            for user, uid in seen_users:
-                f.write(f"{obj_type},{obj_id},{user},{uid}\n")
+                already_done.add(record[:2])
+                if record[2] is not None:
+                    contributors.add(record[:4])
+        METRICS.inc("cache_lookups_total", len(already_done), cache="contributors", result="hit")
+    return contributors, already_done
+
+def contributors_progress_log(use_cache=True):
+    """Return the ProgressLog stage 2 records the processed objects in.
+
+    A --no-cache run writes to its own file, so the objects it processes
+    again do not end up in the contributors cache file twice.
+    """
+    if use_cache:
+        return ProgressLog(CACHE_CONTRIBUTORS_FILE)
+    return ProgressLog(RUN_CONTRIBUTORS_FILE, append=False)
+
+def stage2_fetch_contributors(objects, use_cache=True, api_url=OSM_API_URL, workers=2, rate=2.0):
+    contributors, already_done = read_contributors_cache(use_cache)
+    todo = (
+        (obj_type, str(obj_id)) for obj_type, obj_id in objects
+        if (obj_type, str(obj_id)) not in already_done
+    )
+    fetcher = HistoryFetcher(api_url, rate=rate)
+    requests_made = len(already_done)
+    total_count = len(objects)
+    failed = 0
+    # Only a few requests are queued per worker, and every finished object
+    # goes to the progress log, so an interrupted run resumes where it
+    # stopped (less the last unflushed objects).
+    with ThreadPoolExecutor(workers) as executor, contributors_progress_log(use_cache) as progress:
+        futures = {executor.submit(fetcher.fetch, *obj): obj for obj in islice(todo, workers * 4)}
+        try:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    obj_type, obj_id = futures.pop(future)
+                    for obj in islice(todo, 1):
+                        futures[executor.submit(fetcher.fetch, *obj)] = obj
+                    content = future.result()
+                    if content is None:
+                        failed += 1
+                        continue
+                    requests_made += 1
+                    if requests_made % 50 == 0:
+                        print(f"Requesting history file {requests_made} out of {total_count}")
+                    seen_users = parse_history(obj_type, content) if content else []
+                    for user, uid, _ in seen_users:
+                        contributors.add((obj_type, obj_id, user, uid))
+                    progress.record(obj_type, obj_id, seen_users)
+        finally:
+            for future in futures:
+                future.cancel()
+    if failed:
+        print(f"Could not fetch the history of {failed} objects; run again to retry them.")
     return contributors
 
+def history_versions(history_file, objects):
+    """Yield ((type, id), tag keys, user, uid, timestamp) for each version of objects.
+
+    Other objects are dropped by osmium before they reach Python. Versions
+    come in file order, which for full-history files is by type, id and
+    version.
+    """
+    ids = {'node': set(), 'way': set(), 'relation': set()}
+    for obj_type, obj_id in objects:
+        ids[obj_type].add(int(obj_id))
+    processor = osmium.FileProcessor(history_file)
+    for entity, obj_type in ((osmium.osm.NODE, 'node'), (osmium.osm.WAY, 'way'), (osmium.osm.RELATION, 'relation')):
+        processor.with_filter(osmium.filter.IdFilter(ids[obj_type]).enable_for(entity))
+    for obj in METRICS.count_objects(processor, "history"):
+        obj_type = OSM_TYPES[obj.type_str()]
+        uid = str(obj.uid) if obj.uid else None
+        timestamp = obj.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+        yield (obj_type, str(obj.id)), {tag.k for tag in obj.tags}, obj.user, uid, timestamp
+
+def stage2_contributors_from_history(objects, history_file, use_cache=True):
+    """Find contributors in a local full-history file (.osh.pbf) in one pass."""
+    contributors, already_done = read_contributors_cache(use_cache)
+    todo = [(obj_type, str(obj_id)) for obj_type, obj_id in objects if (obj_type, str(obj_id)) not in already_done]
+    print(f"Reading the history of {len(todo)} objects from {history_file}...")
+    with contributors_progress_log(use_cache) as progress:
+        found = set()
+        for obj, versions in groupby(history_versions(history_file, todo), key=itemgetter(0)):
+            seen_users = etymology_contributors(version[1:] for version in versions)
+            for user, uid, _ in seen_users:
+                contributors.add((*obj, user, uid))
+            progress.record(*obj, seen_users)
+            found.add(obj)
+        # Objects missing from the history file have no contributors either
+        for obj in todo:
+            if obj not in found:
+                progress.record(*obj, [])
+    return contributors
+
+class ContributorStats:
+    """Per-user contribution counts kept up to date from the cache file.
+
+    Holds one entry per user with the number of objects, the number per
+    object type and the first contribution timestamp. The state is saved
+    with the byte offset of the cache file read so far, so each update only
+    reads the lines appended since the last one.
+    """
+
+    def __init__(self, path=STATS_JSON_FILE):
+        self.path = path
+        self.offset = 0
+        self.users = {}
+
+    @classmethod
+    def load(cls, path=STATS_JSON_FILE):
+        stats = cls(path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            stats.offset = data["source_offset"]
+            stats.users = {user["uid"]: user for user in data["users"]}
+        return stats
+
+    def add(self, obj_type, user, uid, timestamp):
+        entry = self.users.get(uid)
+        if entry is None:
+            entry = self.users[uid] = {
+                "uid": uid, "user": user, "objects": 0,
+                "node": 0, "way": 0, "relation": 0, "first_contribution": None,
+            }
+        # Keep the latest user name
+        entry["user"] = user
+        entry["objects"] += 1
+        entry[obj_type] += 1
+        if timestamp and (entry["first_contribution"] is None or timestamp < entry["first_contribution"]):
+            entry["first_contribution"] = timestamp
+
+    def update(self, cache_file=CACHE_CONTRIBUTORS_FILE):
+        """Add the contributions appended to cache_file since the last update."""
+        if not os.path.exists(cache_file):
+            return 0
+        if os.path.getsize(cache_file) < self.offset:
+            print("Contributors cache file has shrunk, recomputing statistics.")
+            self.offset = 0
+            self.users = {}
+        added = 0
+        with open(cache_file, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Partly written line, read it next time
+                    break
+                self.offset += len(line)
+                record = parse_cache_line(line.decode("utf-8"))
+                if record is None or record[2] is None:
+                    continue
+                obj_type, _, user, uid, timestamp = record
+                self.add(obj_type, user, uid, timestamp)
+                added += 1
+        return added
+
+    def sorted_users(self):
+        return sorted(self.users.values(), key=lambda u: (-u["objects"], u["user"]))
+
+    def totals(self):
+        totals = {"contributors": len(self.users), "objects": 0, "node": 0, "way": 0, "relation": 0}
+        for user in self.users.values():
+            for key in ("objects", "node", "way", "relation"):
+                totals[key] += user[key]
+        return totals
+
+    def save(self, csv_file=STATS_CSV_FILE):
+        data = {"source_offset": self.offset, "totals": self.totals(), "users": self.sorted_users()}
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+        with open(csv_file + ".tmp", "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=STATS_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.sorted_users())
+        os.replace(csv_file + ".tmp", csv_file)
+
+def stage3_aggregate(use_cache=True):
+    """Update the contributor statistics with the new cache file lines.
+
+    Without the cache, the statistics of this run's progress file are
+    written to the run statistics files, and the cumulative ones are left
+    alone.
+    """
+    if use_cache:
+        stats = ContributorStats.load()
+        added = stats.update()
+        csv_file = STATS_CSV_FILE
+    else:
+        stats = ContributorStats(RUN_STATS_JSON_FILE)
+        added = stats.update(RUN_CONTRIBUTORS_FILE)
+        csv_file = RUN_STATS_CSV_FILE
+    stats.save(csv_file)
+    print(f"Added {added} contributions to {stats.path} and {csv_file}.")
+    return stats
+
 def main():
     parser = argparse.ArgumentParser(description="Find OSM contributors for name:etymology:wikidata tags.")
     parser.add_argument("pbf_file", help="Input OSM .pbf file")
     parser.add_argument("--no-cache", action="store_true", help="Disable cache usage")
+    parser.add_argument("--candidates",
+                        help="Read objects from a candidates file made by etymology_candidates.py instead of scanning pbf_file")
+    parser.add_argument("--history", metavar="OSH_FILE",
+                        help="Read object histories from a local full-history file (.osh.pbf) instead of the OSM API")
+    parser.add_argument("--api-url", default=os.environ.get("OSM_API_URL", OSM_API_URL),
+                        help="OSM API base URL, e.g. a local mock (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=2, help="Concurrent history requests (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=2.0, help="Max history requests per second (default: %(default)s)")
     args = parser.parse_args()
     use_cache = not args.no_cache
+    start_reporting("get_etymology_contributors")
 
-    objects = stage1_find_objects(args.pbf_file, use_cache=use_cache)
-    contributors = stage2_fetch_contributors(objects, use_cache=use_cache)
+    objects = stage1_find_objects(args.pbf_file, use_cache=use_cache, candidates=args.candidates)
+    if args.history:
+        contributors = stage2_contributors_from_history(objects, args.history, use_cache=use_cache)
+    else:
+        contributors = stage2_fetch_contributors(
+            objects, use_cache=use_cache, api_url=args.api_url, workers=args.workers, rate=args.rate
+        )
     print(f"Found {len(contributors)} contributors.")
-    # Optionally, print or process contributors here
+    stats = stage3_aggregate(use_cache=use_cache)
+    totals = stats.totals()
+    print(f"{totals['contributors']} users added etymology to {totals['objects']} objects.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,251 @@
+"""Process-wide counters and histograms with a periodic reporter.
+
+The tools count what they do (objects per type, bytes, database rows,
+HTTP requests by status and latency, retries, cache hits) in the shared
+METRICS registry. Nothing is written unless reporting is started, which
+the tools do from the OSMTOOLS_METRICS environment variable:
+
+    OSMTOOLS_METRICS=run.jsonl      append a JSON line every interval
+    OSMTOOLS_METRICS=run.prom       rewrite a Prometheus textfile
+    OSMTOOLS_METRICS=-              JSON lines on stderr
+
+OSMTOOLS_METRICS_INTERVAL sets the interval in seconds (default 30). A
+last report is written when the process exits.
+"""
+
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Upper bounds in seconds of the HTTP latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Objects or rows counted locally before they are added to the registry
+FLUSH_EVERY = 10000
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+
+class Metrics:
+    """Thread-safe registry of counters and histograms."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+        self.last_report = (self.started, {})
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": buckets,
+                    "counts": [0] * len(buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def observe_http(self, service, seconds, status, size=0):
+        """Record one HTTP request; status is the code or "error"."""
+        self.observe("http_request_seconds", seconds, service=service)
+        self.inc("http_responses_total", service=service, status=str(status))
+        if size:
+            self.inc("http_bytes_total", size, service=service)
+
+    def count_objects(self, objects, source):
+        """Yield objects from an osmium iterator, counting them per type."""
+        counts = {}
+        pending = 0
+        try:
+            for obj in objects:
+                otype = obj.type_str()
+                counts[otype] = counts.get(otype, 0) + 1
+                pending += 1
+                if pending >= FLUSH_EVERY:
+                    self._flush_objects(counts, source)
+                    counts = {}
+                    pending = 0
+                yield obj
+        finally:
+            self._flush_objects(counts, source)
+
+    def _flush_objects(self, counts, source):
+        names = {"n": "node", "w": "way", "r": "relation", "c": "changeset"}
+        for otype, count in counts.items():
+            self.inc("osm_objects_total", count, source=source, type=names.get(otype, otype))
+
+    def count_rows(self, rows, query):
+        """Yield rows from a database cursor, counting them."""
+        pending = 0
+        try:
+            for row in rows:
+                pending += 1
+                if pending >= FLUSH_EVERY:
+                    self.inc("db_rows_total", pending, query=query)
+                    pending = 0
+                yield row
+        finally:
+            self.inc("db_rows_total", pending, query=query)
+
+    def changes_since(self, counters):
+        """Return the counter increments since counters was collected."""
+        current, _ = self.collect()
+        return {key: value - counters.get(key, 0) for key, value in current.items() if value != counters.get(key, 0)}
+
+    def merge(self, changes):
+        """Add counter increments, e.g. from changes_since in a worker process."""
+        with self.lock:
+            for key, value in changes.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def collect(self):
+        """Return copies of the counters and histograms."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {
+                key: {**value, "counts": list(value["counts"])}
+                for key, value in self.histograms.items()
+            }
+        return counters, histograms
+
+    def json_report(self, job):
+        """Return the current values, with per-second rates since the last call."""
+        now = time.monotonic()
+        counters, histograms = self.collect()
+        last_time, last_counters = self.last_report
+        self.last_report = (now, counters)
+        interval = max(now - last_time, 1e-9)
+        return {
+            "job": job,
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "elapsed": round(now - self.started, 1),
+            "peak_rss_mb": round(peak_rss_bytes() / 1048576, 1),
+            "counters": {_format_key(*key): value for key, value in counters.items()},
+            "rates": {
+                _format_key(*key): round((value - last_counters.get(key, 0)) / interval, 2)
+                for key, value in counters.items()
+            },
+            "histograms": {
+                _format_key(*key): {
+                    "count": value["count"],
+                    "sum": round(value["sum"], 3),
+                    "buckets": dict(zip(map(str, value["buckets"]), value["counts"])),
+                }
+                for key, value in histograms.items()
+            },
+        }
+
+    def prometheus(self, job):
+        """Return the current values in the Prometheus text exposition format."""
+        counters, histograms = self.collect()
+
+        def labels(pairs, extra=()):
+            pairs = (("job", job),) + tuple(pairs) + tuple(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        for (name, pairs), value in sorted(counters.items()):
+            lines.append(f"osmtools_{name}{labels(pairs)} {value}")
+        for (name, pairs), value in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(value["buckets"], value["counts"]):
+                cumulative += count
+                lines.append(f"osmtools_{name}_bucket{labels(pairs, [('le', bound)])} {cumulative}")
+            lines.append(f"osmtools_{name}_bucket{labels(pairs, [('le', '+Inf')])} {value['count']}")
+            lines.append(f"osmtools_{name}_sum{labels(pairs)} {value['sum']}")
+            lines.append(f"osmtools_{name}_count{labels(pairs)} {value['count']}")
+        lines.append(f"osmtools_peak_rss_bytes{labels(())} {peak_rss_bytes()}")
+        lines.append(f"osmtools_elapsed_seconds{labels(())} {time.monotonic() - self.started:.1f}")
+        lines.append(f"osmtools_last_report_timestamp_seconds{labels(())} {time.time():.0f}")
+        return "\n".join(lines) + "\n"
+
+
+def peak_rss_bytes():
+    """Peak RSS of this process or its largest child, e.g. a worker process."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(own, children) * scale
+
+
+class Reporter:
+    """Writes METRICS to path every interval seconds from a daemon thread."""
+
+    def __init__(self, metrics, path, interval, job):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.job = job
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def report(self):
+        with self.lock:
+            if self.path.endswith(".prom"):
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(self.metrics.prometheus(self.job))
+                os.replace(tmp_path, self.path)
+                return
+            line = json.dumps(self.metrics.json_report(self.job))
+            if self.path == "-":
+                print(line, file=sys.stderr, flush=True)
+            else:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.report()
+
+
+METRICS = Metrics()
+_reporter = None
+
+
+def start_reporting(job, path=None, interval=None):
+    """Start reporting METRICS for job, by default as set in the environment.
+
+    Does nothing if no path is given or configured.
+    """
+    global _reporter
+    path = path or os.environ.get("OSMTOOLS_METRICS")
+    if not path or _reporter is not None:
+        return None
+    interval = interval or float(os.environ.get("OSMTOOLS_METRICS_INTERVAL", 30))
+    _reporter = Reporter(METRICS, path, interval, job)
+    threading.Thread(target=_reporter.run, daemon=True).start()
+    atexit.register(_reporter.stop)
+    return _reporter
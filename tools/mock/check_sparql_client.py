@@ -0,0 +1,80 @@
+"""Check throughput and rate-limit compliance of the SPARQL client offline.
+
+Starts the fake endpoint in-process, runs SparqlClient over a set of
+synthetic QIDs and prints a JSON report. The exit status is 1 if the
+client broke the endpoint's limits (too many concurrent requests, URLs that
+are too long or missing User-Agent) or lost any results.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sparql_client import SparqlClient, make_batches  # noqa: E402
+from sparql_endpoint import named_after, start_server  # noqa: E402
+
+QUERY_TEMPLATE = """
+SELECT ?item ?namedAfter ?namedAfterLabel WHERE {{
+  VALUES ?item {{ {wikidata_ids} }}
+  OPTIONAL {{ ?item wdt:P138 ?namedAfter. }}
+}}
+"""
+
+
+def build_query(batch):
+    return QUERY_TEMPLATE.format(wikidata_ids=" ".join(f"wd:{qid}" for qid in batch))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=5000, help="Number of QIDs to query")
+    parser.add_argument("--concurrency", type=int, default=4, help="Client concurrency")
+    parser.add_argument("--rate", type=float, default=4.0, help="Client requests per second")
+    parser.add_argument("--server-concurrency", type=int, default=5)
+    parser.add_argument("--server-rate", type=float, default=5.0)
+    parser.add_argument("--delay", type=float, default=0.05, help="Fake query time in seconds")
+    args = parser.parse_args()
+
+    server = start_server(
+        max_concurrent=args.server_concurrency, rate=args.server_rate, delay=args.delay
+    )
+    client = SparqlClient(
+        "osmtools-check/1.0", endpoint_url=server.url(), concurrency=args.concurrency, rate=args.rate
+    )
+    qids = [f"Q{n}" for n in range(1, args.items + 1)]
+    expected = sum(1 for qid in qids if named_after(qid))
+
+    start = time.monotonic()
+    found = set()
+    for batch, data in client.run(make_batches(qids, build_query), build_query):
+        for binding in (data or {}).get("results", {}).get("bindings", []):
+            if "namedAfter" in binding:
+                found.add(binding["item"]["value"].rsplit("/", 1)[-1])
+    elapsed = time.monotonic() - start
+    server.shutdown()
+
+    report = {
+        "items": len(qids),
+        "seconds": round(elapsed, 3),
+        "items_per_second": round(len(qids) / elapsed, 1),
+        "client": client.stats,
+        "server": server.stats,
+        "named_after_expected": expected,
+        "named_after_found": len(found),
+    }
+    print(json.dumps(report, indent=2))
+    ok = (
+        server.stats["max_active"] <= args.server_concurrency
+        and server.stats["too_long"] == 0
+        and server.stats["missing_user_agent"] == 0
+        and len(found) == expected
+    )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Threaded HTTP server base for the fake services, with API-style limits.
+
+Requests beyond max_concurrent in flight, or beyond rate per second, are
+answered with HTTP 429 and a Retry-After header, and counted in stats.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LimitedServer(ThreadingHTTPServer):
+    daemon_threads = True
+    path_prefix = "/"
+
+    def __init__(self, address, handler_class, max_concurrent=5, rate=5.0, delay=0.05, retry_after=1):
+        super().__init__(address, handler_class)
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.delay = delay
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.active = 0
+        self.recent = deque()
+        self.stats = {
+            "requests": 0,
+            "answered": 0,
+            "throttled": 0,
+            "max_active": 0,
+            "missing_user_agent": 0,
+        }
+
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{self.path_prefix}"
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def admit(self):
+        """Return True if a new request is within the limits."""
+        with self.lock:
+            now = time.monotonic()
+            self.stats["requests"] += 1
+            while self.recent and self.recent[0] <= now - 1:
+                self.recent.popleft()
+            if self.active >= self.max_concurrent or len(self.recent) >= self.rate:
+                self.stats["throttled"] += 1
+                return False
+            self.recent.append(now)
+            self.active += 1
+            self.stats["max_active"] = max(self.stats["max_active"], self.active)
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            self.stats["answered"] += 1
+
+
+class LimitedHandler(BaseHTTPRequestHandler):
+    """Request handler that applies the server limits before answer()."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, data, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status, body, headers=None):
+        self.send_body(status, json.dumps(body).encode("utf-8"), "application/json", headers)
+
+    def do_GET(self):
+        server = self.server
+        if not self.headers.get("User-Agent"):
+            server.count("missing_user_agent")
+        if not self.check():
+            return
+        if not server.admit():
+            self.send_json(429, {"error": "Too many requests"}, {"Retry-After": str(server.retry_after)})
+            return
+        try:
+            time.sleep(server.delay)
+            self.answer()
+        finally:
+            server.release()
+
+    def check(self):
+        """Reject a request before the limits apply; return False if answered."""
+        return True
+
+    def answer(self):
+        raise NotImplementedError
+
+
+def start_server(server):
+    """Serve server from a background thread and return it."""
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
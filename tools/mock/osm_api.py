@@ -0,0 +1,112 @@
+"""Fake OSM API serving synthetic object histories for offline runs.
+
+Answers /api/0.6/<type>/<id>/history with a deterministic history in
+which name:etymology:wikidata is added by one of a few synthetic users.
+It applies the same concurrency and rate limits as the other fake
+services. Point get_etymology_contributors.py at it with
+--api-url http://127.0.0.1:<port>/api/0.6.
+"""
+
+import argparse
+import json
+import re
+from xml.sax.saxutils import quoteattr
+
+from limited_server import LimitedHandler, LimitedServer
+from limited_server import start_server as start_limited_server
+
+HISTORY_PATH = re.compile(r"^/api/0\.6/(node|way|relation)/([0-9]+)/history$")
+
+
+def history_versions(obj_id):
+    """Return the synthetic (version, user, uid, tags) history of an object."""
+    versions = []
+    tags = {"name": f"Object {obj_id}"}
+    etymology_version = 1 + obj_id % 3
+    for version in range(1, 2 + obj_id % 4):
+        uid = (obj_id + version) % 17 + 1
+        if version == etymology_version:
+            tags = {**tags, "name:etymology:wikidata": f"Q{obj_id}"}
+        versions.append((version, f"user{uid}", uid, dict(tags)))
+    return versions
+
+
+def expected_contributors(obj_type, obj_id):
+    """Return the (type, id, user, uid) records a correct client finds."""
+    result = []
+    had_etymology = False
+    for version, user, uid, tags in history_versions(obj_id):
+        has_etymology = "name:etymology:wikidata" in tags
+        if has_etymology and not had_etymology:
+            result.append((obj_type, str(obj_id), user, str(uid)))
+        had_etymology = has_etymology
+    return result
+
+
+def history_xml(obj_type, obj_id):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6" generator="osmtools mock">']
+    for version, user, uid, tags in history_versions(obj_id):
+        attrs = (
+            f'id="{obj_id}" version="{version}" visible="true" changeset="{version}" '
+            f'timestamp="2020-01-{version:02d}T00:00:00Z" user={quoteattr(user)} uid="{uid}"'
+        )
+        if obj_type == "node":
+            attrs += ' lat="55.0" lon="10.0"'
+        lines.append(f"  <{obj_type} {attrs}>")
+        if obj_type == "way":
+            lines.append('    <nd ref="1"/>')
+            lines.append('    <nd ref="2"/>')
+        for key, value in tags.items():
+            lines.append(f"    <tag k={quoteattr(key)} v={quoteattr(value)}/>")
+        lines.append(f"  </{obj_type}>")
+    lines.append("</osm>")
+    return "\n".join(lines).encode("utf-8")
+
+
+class FakeOsmApiServer(LimitedServer):
+    path_prefix = "/api/0.6"
+
+    def __init__(self, address, **limits):
+        super().__init__(address, FakeOsmApiHandler, **limits)
+
+
+class FakeOsmApiHandler(LimitedHandler):
+    def answer(self):
+        match = HISTORY_PATH.match(self.path)
+        if not match:
+            self.send_body(404, b"Not found", "text/plain")
+            return
+        obj_type, obj_id = match.group(1), int(match.group(2))
+        if obj_id % 1000 == 999:
+            # Some objects have been deleted and redacted
+            self.send_body(410, b"Gone", "text/plain")
+            return
+        self.send_body(200, history_xml(obj_type, obj_id), "text/xml; charset=utf-8")
+
+
+def start_server(host="127.0.0.1", port=0, **limits):
+    """Start a FakeOsmApiServer in a background thread and return it."""
+    return start_limited_server(FakeOsmApiServer((host, port), **limits))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake OSM API with object histories.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8892)
+    parser.add_argument("--max-concurrent", type=int, default=4, help="Concurrent requests allowed")
+    parser.add_argument("--rate", type=float, default=10.0, help="Requests allowed per second")
+    parser.add_argument("--delay", type=float, default=0.05, help="Seconds spent per request")
+    args = parser.parse_args()
+
+    server = FakeOsmApiServer(
+        (args.host, args.port),
+        max_concurrent=args.max_concurrent,
+        rate=args.rate,
+        delay=args.delay,
+    )
+    print(f"Serving fake OSM API on {server.url()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats, indent=2))
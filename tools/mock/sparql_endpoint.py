@@ -0,0 +1,107 @@
+"""Fake Wikidata SPARQL endpoint for offline runs of the SPARQL client.
+
+It answers the VALUES queries of wikidata_etymology_to_osm.py with
+deterministic named-after (P138) bindings and enforces a concurrency and
+rate limit like the real service, answering HTTP 429 with Retry-After when
+a client goes over it. Point the tools at it with
+WIKIDATA_SPARQL_URL=http://127.0.0.1:<port>/sparql.
+"""
+
+import argparse
+import json
+import re
+from urllib.parse import parse_qs, urlparse
+
+from limited_server import LimitedHandler, LimitedServer
+from limited_server import start_server as start_limited_server
+
+QID_PATTERN = re.compile(r"wd:(Q[0-9]+)")
+
+# Longest request URL accepted before answering 414, like the real service
+MAX_URL_LENGTH = 8192
+
+
+def named_after(qid):
+    """Return the synthetic (id, label) pairs an item is named after."""
+    n = int(qid[1:])
+    result = []
+    if n % 3 == 0:
+        result.append((f"Q{n + 1000000}", f"Person {n}"))
+    if n % 9 == 0:
+        result.append((f"Q{n + 2000000}", f"Other person {n}"))
+    return result
+
+
+def sparql_result(qids):
+    bindings = []
+    for qid in qids:
+        item = {"type": "uri", "value": f"http://www.wikidata.org/entity/{qid}"}
+        pairs = named_after(qid)
+        if not pairs:
+            bindings.append({"item": item})
+        for named_after_id, label in pairs:
+            bindings.append(
+                {
+                    "item": item,
+                    "namedAfter": {
+                        "type": "uri",
+                        "value": f"http://www.wikidata.org/entity/{named_after_id}",
+                    },
+                    "namedAfterLabel": {"type": "literal", "value": label},
+                }
+            )
+    return {"head": {"vars": ["item", "namedAfter", "namedAfterLabel"]}, "results": {"bindings": bindings}}
+
+
+class FakeSparqlServer(LimitedServer):
+    path_prefix = "/sparql"
+
+    def __init__(self, address, **limits):
+        super().__init__(address, FakeSparqlHandler, **limits)
+        self.stats.update({"too_long": 0, "max_url_length": 0})
+
+
+class FakeSparqlHandler(LimitedHandler):
+    def check(self):
+        server = self.server
+        with server.lock:
+            server.stats["max_url_length"] = max(
+                server.stats["max_url_length"], len(self.path)
+            )
+        if len(self.path) > MAX_URL_LENGTH:
+            server.count("too_long")
+            self.send_json(414, {"error": "URI too long"})
+            return False
+        return True
+
+    def answer(self):
+        query = parse_qs(urlparse(self.path).query).get("query", [""])[0]
+        self.send_json(200, sparql_result(QID_PATTERN.findall(query)))
+
+
+def start_server(host="127.0.0.1", port=0, **limits):
+    """Start a FakeSparqlServer in a background thread and return it."""
+    return start_limited_server(FakeSparqlServer((host, port), **limits))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake Wikidata SPARQL endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8890)
+    parser.add_argument("--max-concurrent", type=int, default=5, help="Concurrent requests allowed")
+    parser.add_argument("--rate", type=float, default=5.0, help="Requests allowed per second")
+    parser.add_argument("--delay", type=float, default=0.05, help="Seconds spent per query")
+    args = parser.parse_args()
+
+    server = FakeSparqlServer(
+        (args.host, args.port),
+        max_concurrent=args.max_concurrent,
+        rate=args.rate,
+        delay=args.delay,
+    )
+    print(f"Serving fake SPARQL endpoint on {server.url()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats, indent=2))
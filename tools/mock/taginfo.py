@@ -0,0 +1,124 @@
+"""Fake GeoFabrik index and taginfo instances for offline statistics runs.
+
+Serves /index-v1.json with num_areas areas whose taginfo URLs point back
+at this server, and /<area>/api/4/key/stats?key=<key> with deterministic
+counts. Responses carry ETag and Last-Modified headers and conditional
+requests are answered with HTTP 304, like the real services. Point
+count_per_area.py at it with --index-url http://127.0.0.1:<port>/index-v1.json.
+"""
+
+import argparse
+import hashlib
+import json
+import re
+from urllib.parse import parse_qs, urlsplit
+
+from limited_server import LimitedHandler, LimitedServer
+from limited_server import start_server as start_limited_server
+
+LAST_MODIFIED = "Mon, 06 Jan 2025 00:00:00 GMT"
+STATS_PATH = re.compile(r"^/(area-[0-9]+)/api/4/key/stats$")
+
+
+def key_count(area, key):
+    """Return a deterministic object count for key in area."""
+    return int(hashlib.sha1(f"{area}/{key}".encode("utf-8")).hexdigest()[:6], 16) % 50000
+
+
+def key_stats(area, key):
+    count = key_count(area, key)
+    nodes = count // 3
+    ways = count // 2
+    return {
+        "url": f"/api/4/key/stats?key={key}",
+        "data_until": "2025-01-05T21:00:00Z",
+        "data": [
+            {"type": "all", "count": count, "count_fraction": 0.0, "values": 1},
+            {"type": "nodes", "count": nodes, "count_fraction": 0.0, "values": 1},
+            {"type": "ways", "count": ways, "count_fraction": 0.0, "values": 1},
+            {"type": "relations", "count": count - nodes - ways, "count_fraction": 0.0, "values": 1},
+        ],
+    }
+
+
+class FakeTaginfoServer(LimitedServer):
+    def __init__(self, address, num_areas=550, **limits):
+        super().__init__(address, FakeTaginfoHandler, **limits)
+        self.num_areas = num_areas
+
+    def index(self):
+        base = self.url().rstrip("/")
+        return {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "properties": {
+                        "id": f"area-{i}",
+                        "name": f"Area {i}",
+                        "urls": {"taginfo": f"{base}/area-{i}/"},
+                    },
+                    "geometry": None,
+                }
+                for i in range(self.num_areas)
+            ],
+        }
+
+
+class FakeTaginfoHandler(LimitedHandler):
+    def answer(self):
+        url = urlsplit(self.path)
+        if url.path == "/index-v1.json":
+            body = self.server.index()
+        else:
+            match = STATS_PATH.match(url.path)
+            key = parse_qs(url.query).get("key", [""])[0]
+            if not match or not key:
+                self.send_body(404, b"Not found", "text/plain")
+                return
+            body = key_stats(match.group(1), key)
+
+        data = json.dumps(body).encode("utf-8")
+        etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+        headers = {"ETag": etag, "Last-Modified": LAST_MODIFIED}
+        if self.headers.get("If-None-Match") == etag or (
+            not self.headers.get("If-None-Match")
+            and self.headers.get("If-Modified-Since") == LAST_MODIFIED
+        ):
+            self.server.count("not_modified")
+            self.send_response(304)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            return
+        self.send_body(200, data, "application/json", headers)
+
+
+def start_server(host="127.0.0.1", port=0, **options):
+    """Start a FakeTaginfoServer in a background thread and return it."""
+    return start_limited_server(FakeTaginfoServer((host, port), **options))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake GeoFabrik index and taginfo.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8894)
+    parser.add_argument("--areas", type=int, default=550, help="Number of areas in the index")
+    parser.add_argument("--max-concurrent", type=int, default=8, help="Concurrent requests allowed")
+    parser.add_argument("--rate", type=float, default=200.0, help="Requests allowed per second")
+    parser.add_argument("--delay", type=float, default=0.05, help="Seconds spent per request")
+    args = parser.parse_args()
+
+    server = FakeTaginfoServer(
+        (args.host, args.port),
+        num_areas=args.areas,
+        max_concurrent=args.max_concurrent,
+        rate=args.rate,
+        delay=args.delay,
+    )
+    print(f"Serving fake index on {server.url()}index-v1.json")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats, indent=2))
@@ -5,62 +5,710 @@ import sys
 import os
 import argparse
 import re
+import struct
+import tempfile
+import multiprocessing
+import heapq
+from array import array
+from bisect import bisect_left
 
+from etymology_lookup import ITEMS_TABLE, LOOKUP_TABLE, claim_changes
+from metrics import METRICS, start_reporting
 
-class TagUpdaterHandler(osmium.SimpleHandler):
-    """Collect existing tags for a set of node and way ids.
+# Rows per round trip when streaming query results from a server-side cursor
+FETCH_SIZE = 50000
 
-    This handler does not modify tags itself; it records the current tags for
-    the objects so the caller can merge and write updated tags later.
+# Number of PBF data blobs handed to a worker at a time in parallel mode
+BLOBS_PER_TASK = 16
+
+# Gender tags are etymology_has_<gender>. These keys are always checked
+# for stale values, whatever genders gendermap has.
+GENDER_KEY_PREFIX = "etymology_has_"
+GENDER_KEYS = ("etymology_has_male", "etymology_has_female")
+
+# A GenderIndex keeps one bit per gender in a 64-bit mask
+MAX_GENDERS = 64
+
+# Ids that reach a GenderIndex out of order are sorted in chunks of this
+# size, so only one chunk at a time is held as a list of Python ints
+SORT_CHUNK = 1 << 18
+
+# Ways without any of these keys are ignored by the OSRM car profile
+OSRM_WAY_KEYS = ("highway", "route")
+
+
+def rewrite_osm_data(
+    source, writer, node_tags=None, way_tags=None, keys=None, ids=None
+):
+    """Copy every object from source to writer, rewriting tags on the fly.
+
+    node_tags and way_tags are callables that receive the object and return
+    the new tags as a dict, or None to copy the object unchanged. Tags are
+    decided and written in the same pass, so no per-id tag dicts are kept.
+
+    Objects that cannot change are handed to the writer by osmium without
+    reaching Python: relations, nodes or ways without a transform, and, if
+    keys is given, objects that have none of those tag keys. ids can map
+    'n' and 'w' to the only node and way ids to look at.
+
+    Returns the number of updated nodes and ways.
+    """
+    entities = osmium.osm.NOTHING
+    if node_tags:
+        entities |= osmium.osm.NODE
+    if way_tags:
+        entities |= osmium.osm.WAY
+    processor = osmium.FileProcessor(source)
+    processor.with_filter(osmium.filter.EntityFilter(entities))
+    if keys:
+        processor.with_filter(osmium.filter.KeyFilter(*keys))
+    if ids is not None:
+        for otype, entity in (("n", osmium.osm.NODE), ("w", osmium.osm.WAY)):
+            processor.with_filter(
+                osmium.filter.IdFilter(ids[otype]).enable_for(entity)
+            )
+    processor.handler_for_filtered(writer)
+
+    updated_nodes = 0
+    updated_ways = 0
+    for obj in METRICS.count_objects(processor, "rewrite"):
+        if obj.is_node():
+            tags = node_tags(obj)
+            if tags is None:
+                writer.add_node(obj)
+                continue
+            mobj = osmium.osm.mutable.Node(obj)
+            updated_nodes += 1
+        else:
+            tags = way_tags(obj)
+            if tags is None:
+                writer.add_way(obj)
+                continue
+            mobj = osmium.osm.mutable.Way(obj)
+            updated_ways += 1
+        mobj.tags = [(k, v) for k, v in tags.items()]
+        writer.add(mobj)
+    METRICS.inc("osm_objects_updated_total", updated_nodes, type="node")
+    METRICS.inc("osm_objects_updated_total", updated_ways, type="way")
+    return updated_nodes, updated_ways
+
+
+def rewrite_osm_file(
+    input_file,
+    output_file,
+    node_tags=None,
+    way_tags=None,
+    keys=None,
+    ids=None,
+    source="rewrite",
+):
+    """Read input_file once and write output_file with rewritten tags.
+
+    The input bytes are counted under source as they are read.
+    """
+    updated_nodes = 0
+    updated_ways = 0
+    writer = osmium.SimpleWriter(output_file)
+    try:
+        for data, length in read_in_ranges(input_file):
+            nodes, ways = rewrite_osm_data(
+                data, writer, node_tags, way_tags, keys, ids
+            )
+            updated_nodes += nodes
+            updated_ways += ways
+            METRICS.inc("input_bytes_total", length, source=source)
+    finally:
+        writer.close()
+    print(f"Nodes updated: {updated_nodes}; Ways updated: {updated_ways}")
+    print(f"Wrote updated data to {output_file}")
+
+
+def extract_osrm_routing_file(input_file, output_file, way_tags=None):
+    """Write a routing-only file for osrm-extract with enriched ways.
+
+    Only ways with one of OSRM_WAY_KEYS and turn restriction relations are
+    kept, together with the nodes they reference. Referenced nodes keep
+    their tags, since the profile reads barriers from them. Everything else
+    (POIs, buildings, other relations) is dropped. Only ways are enriched.
+    """
+    updated_ways = 0
+    written = {"w": 0, "r": 0}
+    with osmium.BackReferenceWriter(
+        output_file, ref_src=input_file, remove_tags=False
+    ) as writer:
+        for data, length in read_in_ranges(input_file):
+            processor = osmium.FileProcessor(
+                data, osmium.osm.WAY | osmium.osm.RELATION
+            )
+            processor.with_filter(
+                osmium.filter.KeyFilter(*OSRM_WAY_KEYS).enable_for(osmium.osm.WAY)
+            )
+            processor.with_filter(
+                osmium.filter.TagFilter(("type", "restriction")).enable_for(
+                    osmium.osm.RELATION
+                )
+            )
+            for obj in METRICS.count_objects(processor, "osrm"):
+                written[obj.type_str()] += 1
+                tags = way_tags(obj) if way_tags and obj.is_way() else None
+                if tags is None:
+                    writer.add(obj)
+                    continue
+                mway = osmium.osm.mutable.Way(obj)
+                mway.tags = [(k, v) for k, v in tags.items()]
+                writer.add(mway)
+                updated_ways += 1
+            METRICS.inc("input_bytes_total", length, source="osrm")
+    print(
+        f"Kept {written['w']} ways and {written['r']} turn restrictions; "
+        f"Ways updated: {updated_ways}"
+    )
+    print(f"Wrote routing data to {output_file}")
+
+
+def _copy_object(obj):
+    """Return a mutable copy of obj that stays valid after the callback."""
+    attrs = {
+        "id": obj.id,
+        "version": obj.version,
+        "visible": obj.visible,
+        "changeset": obj.changeset,
+        "timestamp": obj.timestamp,
+        "uid": obj.uid,
+        "user": obj.user,
+        "tags": dict(obj.tags),
+    }
+    if obj.is_node():
+        location = osmium.osm.Location()
+        if obj.location.valid():
+            location = osmium.osm.Location(obj.location.lon, obj.location.lat)
+        return osmium.osm.mutable.Node(location=location, **attrs)
+    if obj.is_way():
+        return osmium.osm.mutable.Way(nodes=[n.ref for n in obj.nodes], **attrs)
+    members = [(m.type, m.ref, m.role) for m in obj.members]
+    return osmium.osm.mutable.Relation(members=members, **attrs)
+
+
+def read_change_file(change_file):
+    """Return the newest version of every object in an OSM change file.
+
+    The result maps 'n', 'w' and 'r' to dicts of id -> mutable object.
+    Deleted objects are kept with visible set to False.
+    """
+    changes = {"n": {}, "w": {}, "r": {}}
+    for obj in METRICS.count_objects(osmium.FileProcessor(change_file), "changes"):
+        objects = changes[obj.type_str()]
+        current = objects.get(obj.id)
+        if current is None or current.version <= obj.version:
+            objects[obj.id] = _copy_object(obj)
+    return changes
+
+
+def merge_change_file(input_file, change_file, output_file):
+    """Write input_file with the changes of change_file applied to output_file.
+
+    osmium does the merge without handing any object to Python: changed
+    objects replace their old versions, new ones are inserted in order and
+    deleted ones are dropped.
+    """
+    changes = osmium.MergeInputReader()
+    changes.add_file(change_file)
+    reader = osmium.io.Reader(input_file)
+    writer = osmium.io.Writer(output_file, reader.header())
+    try:
+        changes.apply_to_reader(reader, writer, False)
+    finally:
+        reader.close()
+        writer.close()
+    METRICS.inc("input_bytes_total", os.path.getsize(input_file), source="merge")
+
+
+def _pick_transform(changed_ids, changed_transform, transform):
+    """Return a transform using changed_transform for ids in changed_ids."""
+    if changed_transform is None and transform is None:
+        return None
+
+    def pick(obj):
+        chosen = changed_transform if obj.id in changed_ids else transform
+        return chosen(obj) if chosen else None
+
+    return pick
+
+
+def read_recheck_objects(input_file, recheck, node_tags=None, way_tags=None):
+    """Return copies of the recheck objects of input_file whose tags change.
+
+    recheck maps 'n' and 'w' to ids; only those objects reach Python. The
+    result maps 'n' and 'w' to dicts of id -> mutable object.
+    """
+    transforms = {"n": node_tags, "w": way_tags}
+    entities = osmium.osm.NOTHING
+    if node_tags:
+        entities |= osmium.osm.NODE
+    if way_tags:
+        entities |= osmium.osm.WAY
+    retagged = {"n": {}, "w": {}}
+    for data, length in read_in_ranges(input_file):
+        processor = osmium.FileProcessor(data, entities)
+        for otype, entity in (("n", osmium.osm.NODE), ("w", osmium.osm.WAY)):
+            processor.with_filter(
+                osmium.filter.IdFilter(recheck[otype]).enable_for(entity)
+            )
+        for obj in METRICS.count_objects(processor, "recheck"):
+            otype = obj.type_str()
+            tags = transforms[otype](obj)
+            if tags is not None:
+                mobj = _copy_object(obj)
+                mobj.tags = [(k, v) for k, v in tags.items()]
+                retagged[otype][obj.id] = mobj
+        METRICS.inc("input_bytes_total", length, source="recheck")
+    return retagged
+
+
+def apply_changes_to_osm_file(
+    input_file,
+    change_file,
+    output_file,
+    node_tags=None,
+    way_tags=None,
+    changed_node_tags=None,
+    changed_way_tags=None,
+    changes=None,
+    recheck=None,
+):
+    """Update a previously enriched file with an OSM change file.
+
+    Objects from the change file get the changed_* transforms. Of the other
+    objects, only those in recheck (e.g. the objects whose Wikidata items
+    changed, see etymology_lookup.claim_changes) get the node_tags/way_tags
+    transforms; the rest are copied by osmium without reaching Python.
+    changes is the result of read_change_file, if already read.
+
+    If output_file is an .osc file, an enriched change file is written
+    instead of a full updated file, without reading the rest of input_file.
+    Re-tagged objects that are not in the change file keep their version,
+    so those with version 1 are written as creations although they exist;
+    they are meant as modifications.
+    """
+    if changes is None:
+        changes = read_change_file(change_file)
+    if recheck is None:
+        recheck = {"n": set(), "w": set()}
+    print(
+        f"Change file has {len(changes['n'])} nodes, {len(changes['w'])} ways "
+        f"and {len(changes['r'])} relations; {len(recheck['n'])} nodes and "
+        f"{len(recheck['w'])} ways to re-check"
+    )
+    if output_file.endswith((".osc", ".osc.gz", ".osc.bz2")):
+        write_enriched_changes(
+            input_file,
+            output_file,
+            changes,
+            {otype: recheck[otype] - changes[otype].keys() for otype in "nw"},
+            node_tags,
+            way_tags,
+            changed_node_tags,
+            changed_way_tags,
+        )
+        return
+
+    tmpdir = tempfile.TemporaryDirectory(dir=os.path.dirname(output_file) or ".")
+    try:
+        merged_file = os.path.join(tmpdir.name, "merged.osm.pbf")
+        merge_change_file(input_file, change_file, merged_file)
+        rewrite_osm_file(
+            merged_file,
+            output_file,
+            _pick_transform(changes["n"], changed_node_tags, node_tags),
+            _pick_transform(changes["w"], changed_way_tags, way_tags),
+            ids={otype: changes[otype].keys() | recheck[otype] for otype in "nw"},
+            source="changes",
+        )
+    finally:
+        tmpdir.cleanup()
+
+
+def write_enriched_changes(
+    input_file,
+    output_file,
+    changes,
+    recheck,
+    node_tags=None,
+    way_tags=None,
+    changed_node_tags=None,
+    changed_way_tags=None,
+):
+    """Write the enriched objects of the change file and the re-tagged
+    recheck objects of input_file to an .osc file."""
+    retagged = read_recheck_objects(input_file, recheck, node_tags, way_tags)
+    changed_transforms = {"n": changed_node_tags, "w": changed_way_tags, "r": None}
+    updated = {"n": 0, "w": 0, "r": 0}
+    with osmium.SimpleWriter(output_file) as writer:
+        for otype in "nwr":
+            objects = dict(retagged.get(otype, {}))
+            updated[otype] += len(objects)
+            transform = changed_transforms[otype]
+            for oid, obj in changes[otype].items():
+                tags = transform(obj) if transform and obj.visible else None
+                if tags is not None:
+                    obj.tags = [(k, v) for k, v in tags.items()]
+                    updated[otype] += 1
+                objects[oid] = obj
+            for oid in sorted(objects):
+                writer.add(objects[oid])
+    METRICS.inc("osm_objects_updated_total", updated["n"], type="node")
+    METRICS.inc("osm_objects_updated_total", updated["w"], type="way")
+    print(f"Nodes updated: {updated['n']}; Ways updated: {updated['w']}")
+    print(f"Wrote enriched changes to {output_file}")
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _parse_blob_header(buf):
+    """Return (type, datasize) from an encoded PBF BlobHeader message."""
+    blob_type = None
+    datasize = 0
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+            if field == 3:
+                datasize = value
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            if field == 1:
+                blob_type = buf[pos : pos + length].decode("ascii")
+            pos += length
+        else:
+            raise ValueError(f"Unexpected wire type {wire_type} in PBF BlobHeader")
+    return blob_type, datasize
+
+
+def pbf_blobs(path):
+    """Yield (offset, length, type) for every blob in a PBF file.
+
+    Only the small BlobHeader of each blob is read; the blob data itself is
+    skipped, so listing the blobs of a country extract is cheap.
+    """
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            size = f.read(4)
+            if not size:
+                break
+            (header_len,) = struct.unpack("!I", size)
+            blob_type, datasize = _parse_blob_header(f.read(header_len))
+            f.seek(datasize, os.SEEK_CUR)
+            length = 4 + header_len + datasize
+            yield offset, length, blob_type
+            offset += length
+
+
+def pbf_blob_ranges(path):
+    """Return the OSMHeader blob of a PBF file and the (start, length)
+    ranges of its data blobs, BLOBS_PER_TASK blobs per range."""
+    header = None
+    data_blobs = []
+    for offset, length, blob_type in pbf_blobs(path):
+        if blob_type == "OSMHeader":
+            with open(path, "rb") as f:
+                f.seek(offset)
+                header = f.read(length)
+        else:
+            data_blobs.append((offset, length))
+    if header is None:
+        raise ValueError(f"No OSMHeader blob found in {path}")
+    ranges = []
+    for i in range(0, len(data_blobs), BLOBS_PER_TASK):
+        blobs = data_blobs[i : i + BLOBS_PER_TASK]
+        start = blobs[0][0]
+        ranges.append((start, blobs[-1][0] + blobs[-1][1] - start))
+    return header, ranges
+
+
+def read_in_ranges(path):
+    """Yield (data, length) pairs that together hold all objects of path.
+
+    A PBF file is read a range of blobs at a time, each put behind the
+    file's header in an osmium FileBuffer, so callers can count the input
+    bytes while the file is read. Other files are yielded whole.
+    """
+    if not path.endswith(".pbf"):
+        yield path, os.path.getsize(path)
+        return
+    header, ranges = pbf_blob_ranges(path)
+    with open(path, "rb") as f:
+        for start, length in ranges:
+            f.seek(start)
+            yield osmium.io.FileBuffer(header + f.read(length), "pbf"), length
+
+
+# Tag transforms and prefilter keys for the worker processes. They are set
+# before the pool is forked, so closures and indexes are shared instead of
+# pickled.
+_worker_transforms = (None, None, None)
+
+
+def _rewrite_blob_range(task):
+    input_file, header, start, length, chunk_file = task
+    with open(input_file, "rb") as f:
+        f.seek(start)
+        data = f.read(length)
+    writer = osmium.SimpleWriter(chunk_file)
+    counters, _ = METRICS.collect()
+    try:
+        updated_nodes, updated_ways = rewrite_osm_data(
+            osmium.io.FileBuffer(header + data, "pbf"), writer, *_worker_transforms
+        )
+    finally:
+        writer.close()
+    # Counts made in the worker process are handed back to the parent
+    return chunk_file, updated_nodes, updated_ways, METRICS.changes_since(counters)
+
+
+def rewrite_osm_file_parallel(
+    input_file, output_file, node_tags=None, way_tags=None, keys=None, jobs=None
+):
+    """Parallel version of rewrite_osm_file for PBF input and output.
+
+    The data blobs of input_file are split into ranges of BLOBS_PER_TASK and
+    rewritten by a pool of forked worker processes. The PBF blobs of the
+    worker outputs are then concatenated in input order behind a single
+    header, so a sorted input gives the same sorted output as the serial
+    rewrite. The blobs are merged into a temporary file next to
+    output_file, which replaces output_file only when all of them are
+    written, so a failed run leaves no partial output behind.
+    """
+    global _worker_transforms
+
+    if not (input_file.endswith(".pbf") and output_file.endswith(".pbf")):
+        raise ValueError("Parallel mode needs .pbf input and output files")
+    if os.path.exists(output_file):
+        raise FileExistsError(f"Output file {output_file} already exists")
+
+    header, ranges = pbf_blob_ranges(input_file)
+
+    updated_nodes = 0
+    updated_ways = 0
+    _worker_transforms = (node_tags, way_tags, keys)
+    tmpdir = tempfile.TemporaryDirectory(dir=os.path.dirname(output_file) or ".")
+    tmp_output = os.path.join(tmpdir.name, "output.osm.pbf")
+    try:
+        tasks = []
+        for start, length in ranges:
+            chunk_file = os.path.join(tmpdir.name, f"chunk_{len(tasks):06d}.osm.pbf")
+            tasks.append((input_file, header, start, length, chunk_file))
+
+        context = multiprocessing.get_context("fork")
+        with context.Pool(jobs) as pool, open(tmp_output, "wb") as out:
+            for i, (chunk_file, nodes, ways, counts) in enumerate(
+                pool.imap(_rewrite_blob_range, tasks)
+            ):
+                METRICS.merge(counts)
+                METRICS.inc("input_bytes_total", tasks[i][3], source="rewrite")
+                with open(chunk_file, "rb") as f:
+                    for offset, length, blob_type in pbf_blobs(chunk_file):
+                        if blob_type == "OSMHeader" and i > 0:
+                            continue
+                        f.seek(offset)
+                        out.write(f.read(length))
+                os.remove(chunk_file)
+                updated_nodes += nodes
+                updated_ways += ways
+        os.replace(tmp_output, output_file)
+    finally:
+        _worker_transforms = (None, None, None)
+        tmpdir.cleanup()
+
+    print(f"Nodes updated: {updated_nodes}; Ways updated: {updated_ways}")
+    print(f"Wrote updated data to {output_file}")
+
+
+def chain_transforms(transforms):
+    """Combine stage transforms into one callable for rewrite_osm_data.
+
+    Each transform is called as transform(obj, tags), where tags is the
+    object's tags as left by the previous stages. It returns a new tag dict,
+    or None to leave the tags unchanged. The combined callable returns None
+    when no stage changed anything.
     """
+    transforms = [t for t in transforms if t is not None]
+    if not transforms:
+        return None
+
+    def transform(obj):
+        tags = obj.tags
+        changed = False
+        for stage_transform in transforms:
+            new_tags = stage_transform(obj, tags)
+            if new_tags is not None:
+                tags = new_tags
+                changed = True
+        return tags if changed else None
+
+    return transform
 
-    def __init__(self, node_ids, way_ids):
-        super().__init__()
-        self.node_ids = set(node_ids)
-        self.way_ids = set(way_ids)
-        self.updated_nodes = {}  # id -> tags (current tags)
-        self.updated_ways = {}  # id -> tags (current tags)
 
-    def node(self, n):
-        if n.id in self.node_ids:
-            self.updated_nodes[n.id] = dict(n.tags)
+class GenderIndex:
+    """Compact lookup of OSM object id -> genders.
+
+    Ids are kept in one sorted array of 64-bit ints, with a parallel array
+    of bitmasks holding one bit per gender, so each object costs 9 bytes
+    (with up to 8 genders) however many genders it has, and a lookup is a
+    single binary search. Pairs sorted by id are indexed as they stream in;
+    other pairs are sorted in chunks and merged.
+    pairs can name several genders for the same id, e.g. for a street named
+    after several people. It supports the dict methods the tag transforms
+    use (get, len, in); get returns a tuple of gender names.
+    """
+
+    def __init__(self, pairs=()):
+        self.names = []
+        self.ids = array("q")
+        self.masks = array("B")
+        self._bits = {}
+        self._genders = {}
+        # Pairs in id order (as the queries return them) are appended as
+        # they come; the rest is collected and merged in at the end
+        unsorted = None
+        for oid, gender in pairs:
+            bit = self._bit(gender)
+            if unsorted is None:
+                if not self.ids or oid > self.ids[-1]:
+                    self.ids.append(oid)
+                    self.masks.append(1 << bit)
+                    continue
+                if oid == self.ids[-1]:
+                    self.masks[-1] |= 1 << bit
+                    continue
+                unsorted = array("q")
+            unsorted.append(oid * MAX_GENDERS + bit)
+        if unsorted is not None:
+            self._merge(unsorted)
+
+    def _bit(self, gender):
+        bit = self._bits.get(gender)
+        if bit is None:
+            bit = len(self.names)
+            if bit == MAX_GENDERS:
+                raise ValueError(f"More than {MAX_GENDERS} genders")
+            self._bits[gender] = bit
+            self.names.append(gender)
+            if bit >= self.masks.itemsize * 8:
+                # The smallest unsigned type with a bit for every gender
+                code = next(code for code in "BHIQ" if array(code).itemsize * 8 > bit)
+                self.masks = array(code, self.masks)
+        return bit
+
+    def _merge(self, keys):
+        """Merge keys (id * MAX_GENDERS + bit, in any order) into the index.
+
+        keys is emptied. It is sorted in chunks of SORT_CHUNK, which are
+        merged with the ids already indexed.
+        """
+        runs = []
+        while keys:
+            runs.append(array("q", sorted(keys[-SORT_CHUNK:])))
+            del keys[-SORT_CHUNK:]
+        ids, masks = self.ids, self.masks
+        runs.append(
+            oid * MAX_GENDERS + bit
+            for oid, mask in zip(ids, masks)
+            for bit in range(mask.bit_length())
+            if mask >> bit & 1
+        )
+        self.ids = array("q")
+        self.masks = array(masks.typecode)
+        for key in heapq.merge(*runs):
+            oid, bit = divmod(key, MAX_GENDERS)
+            if self.ids and self.ids[-1] == oid:
+                self.masks[-1] |= 1 << bit
+            else:
+                self.ids.append(oid)
+                self.masks.append(1 << bit)
 
-    def way(self, w):
-        if w.id in self.way_ids:
-            self.updated_ways[w.id] = dict(w.tags)
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, oid):
+        return self.get(oid) is not None
+
+    def genders(self, mask):
+        """Return the gender names of mask as a tuple, in first-seen order."""
+        genders = self._genders.get(mask)
+        if genders is None:
+            genders = self._genders[mask] = tuple(
+                name for bit, name in enumerate(self.names) if mask >> bit & 1
+            )
+        return genders
+
+    def get(self, oid, default=None):
+        i = bisect_left(self.ids, oid)
+        if i < len(self.ids) and self.ids[i] == oid:
+            return self.genders(self.masks[i])
+        return default
+
+
+def get_gender_names(conn):
+    """Return every gender in gendermap."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT gender FROM gendermap WHERE gender IS NOT NULL")
+        return [gender for (gender,) in cur]
 
 
 # Function to get node and way IDs from Postgres
 def get_all_osm_ids_with_gender_from_db(conn):
-    """Return mappings of OSM object id -> gender for nodes and ways.
+    """Return GenderIndex lookups of OSM object id -> genders for nodes and ways.
 
-    This queries locations_agg joined to wikidata and left-joins gendermap to
-    obtain a gender (e.g. 'male'/'female') for the linked Wikidata entry. Only
-    rows where a gender mapping exists are returned.
+    This queries locations_agg joined to wikidata and gendermap to obtain the
+    genders (e.g. 'male'/'female') of every P21 claim of the linked Wikidata
+    entries. An object linked to several entries gets all their genders.
+    Only rows where a gender mapping exists are returned.
     """
     queries = [("'point'", "node_genders"), ("'line','polygon'", "way_genders")]
-    results = {"node_genders": {}, "way_genders": {}}
+    results = {}
 
-    with conn.cursor() as cur:
-        for geomtype, key in queries:
+    def id_gender_pairs(rows):
+        for row in rows:
+            if row[0]:
+                try:
+                    oid = int(row[0])
+                except (ValueError, TypeError):
+                    continue
+                yield oid, row[1] or ""
+
+    # Rows come sorted by id, so GenderIndex appends them as they stream
+    # in. Repeated (id, gender) pairs are merged there, not in the query.
+    for geomtype, key in queries:
+        with conn.cursor(name=f"osm_add_tags_{key}") as cur:
+            cur.itersize = FETCH_SIZE
             cur.execute(f"""
                 SELECT UNNEST(l.object_ids) AS unnested_id,
-                       COALESCE(g.gender, '') AS gender
+                       g.gender
                   FROM locations_agg l
                   INNER JOIN wikidatamap map ON l.id = map.location_id
                   INNER JOIN wikidata w ON map.wikidata_id = w.itemid
-                  LEFT JOIN gendermap g ON (w.claims->'P21'->0->'mainsnak'->'datavalue'->'value'->>'id') = g.itemid
+                  CROSS JOIN LATERAL jsonb_array_elements(
+                      CASE jsonb_typeof(w.claims->'P21') WHEN 'array' THEN w.claims->'P21' END
+                  ) AS p21(claim)
+                  INNER JOIN gendermap g ON (p21.claim->'mainsnak'->'datavalue'->'value'->>'id') = g.itemid
                 WHERE l.geomtype IN({geomtype})
                   AND g.gender IS NOT NULL
+                ORDER BY 1
             """)
-            for row in cur.fetchall():
-                if row[0]:
-                    try:
-                        oid = int(row[0])
-                    except (ValueError, TypeError):
-                        continue
-                    gender = row[1] or ""
-                    results[key][oid] = gender
+            results[key] = GenderIndex(id_gender_pairs(METRICS.count_rows(cur, key)))
 
     print(
         f"Found {len(results['node_genders'])} nodes and {len(results['way_genders'])} ways with gender mapping"
@@ -68,179 +716,327 @@ def get_all_osm_ids_with_gender_from_db(conn):
     return results["node_genders"], results["way_genders"]
 
 
-# Function to update OSM file with key/value for given node and way IDs
-def update_osm_tags(input_file, node_genders, way_genders, output_file):
-    """Update OSM file adding etymology_has_male/etymology_has_female=yes for objects with genders.
+def get_all_osm_ids_with_gender_from_lookup(conn, ids=None):
+    """Like get_all_osm_ids_with_gender_from_db, from the lookup table.
 
-    node_genders and way_genders are dicts mapping OSM id -> gender string.
+    The table is built and refreshed by etymology_lookup.py, so each query
+    is a sequential read of one table instead of the join above. ids can
+    map 'n' and 'w' to the only node and way ids to read.
     """
-    handler = TagUpdaterHandler(node_genders.keys(), way_genders.keys())
-    handler.apply_file(input_file)
+    results = {}
+
+    def id_gender_pairs(rows):
+        # Items with several genders have them joined with ";"
+        for oid, genders in rows:
+            for gender in genders.split(";"):
+                yield oid, gender
+
+    for osm_type, key in (("n", "node_genders"), ("w", "way_genders")):
+        with conn.cursor(name=f"osm_add_tags_lookup_{key}") as cur:
+            cur.itersize = FETCH_SIZE
+            if ids is None:
+                cur.execute(
+                    f"SELECT osm_id, gender FROM {LOOKUP_TABLE} "
+                    "WHERE osm_type = %s AND gender IS NOT NULL ORDER BY osm_id",
+                    (osm_type,),
+                )
+            else:
+                cur.execute(
+                    f"SELECT osm_id, gender FROM {LOOKUP_TABLE} "
+                    "WHERE osm_type = %s AND osm_id = ANY(%s) AND gender IS NOT NULL "
+                    "ORDER BY osm_id",
+                    (osm_type, sorted(ids[osm_type])),
+                )
+            results[key] = GenderIndex(id_gender_pairs(METRICS.count_rows(cur, key)))
+
     print(
-        f"Nodes to update: {len(handler.updated_nodes)}; Ways to update: {len(handler.updated_ways)}"
+        f"Found {len(results['node_genders'])} nodes and {len(results['way_genders'])} ways with gender mapping"
     )
+    return results["node_genders"], results["way_genders"]
 
-    writer = osmium.SimpleWriter(output_file, osmium.osm.osm_entity_bits.ALL)
 
-    class CopyHandler(osmium.SimpleHandler):
-        def __init__(self, updated_nodes, updated_ways):
-            super().__init__()
-            self.updated_nodes = updated_nodes  # id -> tags
-            self.updated_ways = updated_ways  # id -> tags
+def gender_key(gender):
+    """Return the tag key for gender, e.g. etymology_has_non-binary."""
+    return GENDER_KEY_PREFIX + gender.strip().lower().replace(" ", "_")
 
-        def node(self, n):
-            if n.id in self.updated_nodes:
-                mnode = osmium.osm.mutable.Node(n)
-                mnode.tags = [(k, v) for k, v in self.updated_nodes[n.id].items()]
-                writer.add_node(mnode)
-            else:
-                writer.add_node(n)
 
-        def way(self, w):
-            if w.id in self.updated_ways:
-                mway = osmium.osm.mutable.Way(w)
-                mway.tags = [(k, v) for k, v in self.updated_ways[w.id].items()]
-                writer.add_way(mway)
-            else:
-                writer.add_way(w)
-
-        def relation(self, r):
-            writer.add_relation(r)
-
-    # Build updated maps with correct tag keys based on gender
-    updated_nodes_with_tags = {}
-    for nid, gender in node_genders.items():
-        if gender.lower() == "male":
-            updated_nodes_with_tags[nid] = {
-                **handler.updated_nodes.get(nid, {}),
-                "etymology_has_male": "yes",
-            }
-        elif gender.lower() == "female":
-            updated_nodes_with_tags[nid] = {
-                **handler.updated_nodes.get(nid, {}),
-                "etymology_has_female": "yes",
-            }
-
-    updated_ways_with_tags = {}
-    for wid, gender in way_genders.items():
-        if gender.lower() == "male":
-            updated_ways_with_tags[wid] = {
-                **handler.updated_ways.get(wid, {}),
-                "etymology_has_male": "yes",
-            }
-        elif gender.lower() == "female":
-            updated_ways_with_tags[wid] = {
-                **handler.updated_ways.get(wid, {}),
-                "etymology_has_female": "yes",
-            }
-
-    copy_handler = CopyHandler(updated_nodes_with_tags, updated_ways_with_tags)
-    copy_handler.apply_file(input_file)
-    writer.close()
-    print(f"Wrote updated data to {output_file}")
+def gender_transform(genders, names=(), remove_stale=False):
+    """Return a stage transform setting etymology_has_<gender>=yes from genders.
+
+    genders maps OSM id -> a gender or a tuple of genders, e.g. a
+    GenderIndex. Every gender of an object gets its tag.
+
+    With remove_stale, gender tags that no longer match genders are
+    removed, for the genders in names (all of gendermap), in genders and in
+    GENDER_KEYS, so the transform can be re-applied to an already enriched
+    file. That check looks at every object, so it is only done when the
+    input can be enriched already, i.e. with a change file.
+    """
+    known = set(GENDER_KEYS)
+    known.update(gender_key(name) for name in names)
+    known.update(gender_key(name) for name in getattr(genders, "names", ()))
+    known = tuple(sorted(known))
+    # Wanted tag keys per value of genders; there are few distinct values
+    wanted_keys = {None: ()}
+
+    def transform(obj, tags):
+        value = genders.get(obj.id)
+        if value is None and not remove_stale:
+            return None
+        wanted = wanted_keys.get(value)
+        if wanted is None:
+            values = (value,) if isinstance(value, str) else value
+            wanted = wanted_keys[value] = tuple(
+                sorted({gender_key(gender) for gender in values if gender})
+            )
+        stale = []
+        if remove_stale:
+            stale = [key for key in known if key not in wanted and key in tags]
+        if not stale and all(tags.get(key) == "yes" for key in wanted):
+            return None
+        tags = dict(tags)
+        for key in stale:
+            del tags[key]
+        for key in wanted:
+            tags[key] = "yes"
+        return tags
+
+    return transform
+
+
+# Function to update OSM file with key/value for given node and way IDs
+def update_osm_tags(input_file, node_genders, way_genders, output_file):
+    """Update OSM file adding etymology_has_<gender>=yes for objects with genders.
+
+    node_genders and way_genders map OSM id -> gender string or tuple of
+    gender strings, either as dicts or as GenderIndex lookups.
+    """
+    rewrite_osm_file(
+        input_file,
+        output_file,
+        node_tags=chain_transforms([gender_transform(node_genders)]),
+        way_tags=chain_transforms([gender_transform(way_genders)]),
+    )
 
 
 # Function to update all OSM names
-def get_all_wikidata_descriptions(conn):
+def get_all_wikidata_descriptions(conn, lookup=False):
+    """Return a dict of QID -> "name; description".
+
+    With lookup, the descriptions are read from the items table kept by
+    etymology_lookup.py instead of the wikidata table.
+    """
     descriptions = {}
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT itemid, COALESCE(name || '; ' || description, name) AS description
-            FROM wikidata
-            WHERE description IS NOT NULL
-        """)
-        for itemid, description in cur.fetchall():
+    with conn.cursor(name="osm_add_tags_descriptions") as cur:
+        cur.itersize = FETCH_SIZE
+        if lookup:
+            cur.execute(f"""
+                SELECT wikidata_id, description
+                FROM {ITEMS_TABLE}
+                WHERE description IS NOT NULL
+            """)
+        else:
+            cur.execute("""
+                SELECT itemid, COALESCE(name || '; ' || description, name) AS description
+                FROM wikidata
+                WHERE description IS NOT NULL
+            """)
+        for itemid, description in METRICS.count_rows(cur, "descriptions"):
             descriptions[itemid] = description
     return descriptions
 
 
+def name_transform(descriptions):
+    """Return a stage transform appending the etymology description to name.
+
+    name:etymology:wikidata can list several QIDs separated by ";"; the
+    descriptions of all of them are appended, separated by " / ".
+    """
+    qid_pattern = re.compile(r"^Q[0-9]+$")
+
+    def transform(obj, tags):
+        name = tags.get("name")
+        if not name:
+            return None
+        qids = [
+            qid.strip()
+            for qid in tags.get("name:etymology:wikidata", "").split(";")
+            if qid_pattern.match(qid.strip())
+        ]
+        etym = tags.get("name:etymology")
+        desc = None
+        if qids:
+            found = [descriptions[qid] for qid in qids if qid in descriptions]
+            desc = " / ".join(found)
+        elif etym:
+            desc = etym
+        if not desc:
+            return None
+        tags = dict(tags)
+        tags["name"] = f"{name} [{desc}]"
+        return tags
+
+    return transform
+
+
 # Function to update names in OSM based on Wikidata descriptions
 def update_osm_names_from_description(input_file, descriptions, output_file):
-    class NameUpdateHandler(osmium.SimpleHandler):
-        def __init__(self, descriptions):
-            super().__init__()
-            self.descriptions = descriptions
-            self.updated_nodes = {}
-            self.updated_ways = {}
-            self.qid_pattern = re.compile(r"^Q[0-9]+$")
-
-        def node(self, n):
-            tags = dict(n.tags)
-            name = tags.get("name")
-            qid = tags.get("name:etymology:wikidata")
-            etym = tags.get("name:etymology")
-            desc = None
-            if name:
-                if qid and self.qid_pattern.match(qid):
-                    desc = self.descriptions.get(qid)
-                elif etym:
-                    desc = etym
-                if desc:
-                    tags["name"] = f"{name} [{desc}]"
-                    self.updated_nodes[n.id] = tags
-
-        def way(self, w):
-            tags = dict(w.tags)
-            name = tags.get("name")
-            qid = tags.get("name:etymology:wikidata")
-            etym = tags.get("name:etymology")
-            desc = None
-            if name:
-                if qid and self.qid_pattern.match(qid):
-                    desc = self.descriptions.get(qid)
-                elif etym:
-                    desc = etym
-                if desc:
-                    tags["name"] = f"{name} [{desc}]"
-                    self.updated_ways[w.id] = tags
-
-    handler = NameUpdateHandler(descriptions)
-    handler.apply_file(input_file)
-    print(
-        f"Nodes to update: {len(handler.updated_nodes)}; Ways to update: {len(handler.updated_ways)}"
+    transform = chain_transforms([name_transform(descriptions)])
+    rewrite_osm_file(
+        input_file,
+        output_file,
+        node_tags=transform,
+        way_tags=transform,
+        keys=STAGE_KEYS["update_names"],
     )
 
-    writer = osmium.SimpleWriter(output_file, osmium.osm.osm_entity_bits.ALL)
 
-    class CopyHandler(osmium.SimpleHandler):
-        def __init__(self, updated_nodes, updated_ways):
-            super().__init__()
-            self.updated_nodes = updated_nodes
-            self.updated_ways = updated_ways
+# Enrichment stages. Each loads its data from the database, from the lookup
+# tables if lookup is set, and returns the (node transform, way transform)
+# pair to apply during the rewrite. Stages in IDEMPOTENT_STAGES also take
+# remove_stale (see gender_transform) and ids, the only node and way ids
+# the transforms will see.
+def gender_stage(conn, lookup=False, remove_stale=False, ids=None):
+    if lookup or ids is not None:
+        node_genders, way_genders = get_all_osm_ids_with_gender_from_lookup(conn, ids)
+    else:
+        node_genders, way_genders = get_all_osm_ids_with_gender_from_db(conn)
+    names = get_gender_names(conn)
+    return (
+        gender_transform(node_genders, names, remove_stale),
+        gender_transform(way_genders, names, remove_stale),
+    )
 
-        def node(self, n):
-            if n.id in self.updated_nodes:
-                mnode = osmium.osm.mutable.Node(n)
-                mnode.tags = [(k, v) for k, v in self.updated_nodes[n.id].items()]
-                writer.add_node(mnode)
-            else:
-                writer.add_node(n)
 
-        def way(self, w):
-            if w.id in self.updated_ways:
-                mway = osmium.osm.mutable.Way(w)
-                mway.tags = [(k, v) for k, v in self.updated_ways[w.id].items()]
-                writer.add_way(mway)
-            else:
-                writer.add_way(w)
+def names_stage(conn, lookup=False):
+    transform = name_transform(get_all_wikidata_descriptions(conn, lookup))
+    return transform, transform
 
-        def relation(self, r):
-            writer.add_relation(r)
 
-    copy_handler = CopyHandler(handler.updated_nodes, handler.updated_ways)
-    copy_handler.apply_file(input_file)
-    writer.close()
-    print(f"Wrote updated data to {output_file}")
+STAGES = {
+    "add_gender_tags": gender_stage,
+    "update_names": names_stage,
+}
+
+# Stages whose transforms can be re-applied to an already enriched object.
+# Only these are re-checked for objects outside the change file.
+IDEMPOTENT_STAGES = {"add_gender_tags"}
+
+# Tag keys an object needs at least one of for a stage to change it. Stages
+# not listed here (e.g. gender, which goes by object id) need every object.
+STAGE_KEYS = {
+    "update_names": ("name:etymology:wikidata", "name:etymology"),
+}
+
+
+def prefilter_keys(features):
+    """Return the tag keys to prefilter on for features, or None for all."""
+    if not all(feature in STAGE_KEYS for feature in features):
+        return None
+    keys = []
+    for feature in features:
+        keys.extend(k for k in STAGE_KEYS[feature] if k not in keys)
+    return keys
+
+
+def run_stages(
+    conn,
+    features,
+    input_file,
+    output_file,
+    jobs=1,
+    change_file=None,
+    ways_only=False,
+    profile="full",
+    lookup=False,
+):
+    """Run several enrichment stages in one read/write of the OSM file.
+
+    Stages are applied in the order given, so later stages see the tags
+    written by earlier ones. With jobs > 1 the file is rewritten in
+    parallel worker processes. With a change_file, input_file is a
+    previously enriched file that is updated with the changes. With
+    ways_only, nodes are copied unchanged without being looked at.
+
+    The "osrm" profile writes only the data osrm-extract needs, see
+    extract_osrm_routing_file. With lookup, the stages read the tables
+    kept by etymology_lookup.py.
+
+    With a change_file, the lookup tables are always used: besides the
+    objects in the change file, only the objects whose Wikidata items
+    changed since the last run (etymology_lookup.claim_changes) are looked
+    at, and only their genders are read. The claimed changes are committed
+    once the output is written.
+    """
+    changes = recheck = None
+    if change_file:
+        lookup = True
+        changes = read_change_file(change_file)
+        recheck = claim_changes(conn)
+        stage_ids = {otype: changes[otype].keys() | recheck[otype] for otype in "nw"}
+    node_transforms = []
+    way_transforms = []
+    idempotent_node_transforms = []
+    idempotent_way_transforms = []
+    for feature in features:
+        if change_file and feature in IDEMPOTENT_STAGES:
+            # The input is already enriched, so its tags may be stale
+            node_transform, way_transform = STAGES[feature](
+                conn, lookup, remove_stale=True, ids=stage_ids
+            )
+        else:
+            node_transform, way_transform = STAGES[feature](conn, lookup)
+        if ways_only:
+            node_transform = None
+        node_transforms.append(node_transform)
+        way_transforms.append(way_transform)
+        if feature in IDEMPOTENT_STAGES:
+            idempotent_node_transforms.append(node_transform)
+            idempotent_way_transforms.append(way_transform)
+    if profile == "osrm":
+        extract_osrm_routing_file(
+            input_file, output_file, way_tags=chain_transforms(way_transforms)
+        )
+        return
+    if change_file:
+        apply_changes_to_osm_file(
+            input_file,
+            change_file,
+            output_file,
+            node_tags=chain_transforms(idempotent_node_transforms),
+            way_tags=chain_transforms(idempotent_way_transforms),
+            changed_node_tags=chain_transforms(node_transforms),
+            changed_way_tags=chain_transforms(way_transforms),
+            changes=changes,
+            recheck=recheck,
+        )
+        conn.commit()
+        return
+    if jobs > 1:
+        rewrite_osm_file_parallel(
+            input_file,
+            output_file,
+            node_tags=chain_transforms(node_transforms),
+            way_tags=chain_transforms(way_transforms),
+            keys=prefilter_keys(features),
+            jobs=jobs,
+        )
+        return
+    rewrite_osm_file(
+        input_file,
+        output_file,
+        node_tags=chain_transforms(node_transforms),
+        way_tags=chain_transforms(way_transforms),
+        keys=prefilter_keys(features),
+    )
 
 
 def run_add_gender_tags(conn, input_file, output_file):
-    node_genders, way_genders = get_all_osm_ids_with_gender_from_db(conn)
-    update_osm_tags(input_file, node_genders, way_genders, output_file)
+    run_stages(conn, ["add_gender_tags"], input_file, output_file)
 
 
 def run_update_names(conn, input_file, output_file):
-    descriptions = get_all_wikidata_descriptions(conn)
-    update_osm_names_from_description(input_file, descriptions, output_file)
+    run_stages(conn, ["update_names"], input_file, output_file)
 
 
 if __name__ == "__main__":
@@ -249,13 +1045,57 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "feature",
-        choices=["add_gender_tags", "update_names"],
-        help="Feature to run: add_gender_tags or update_names",
+        nargs="+",
+        choices=list(STAGES),
+        help="Features to run: add_gender_tags and/or update_names. "
+        "Several features are applied in order in a single pass",
     )
     parser.add_argument("schema", help="Postgres schema to use")
     parser.add_argument("input_file", help="Input OSM or PBF file")
     parser.add_argument("output_file", help="Output OSM or PBF file")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes (PBF input and output only). "
+        "Use 0 for one per CPU core (default: 1)",
+    )
+    parser.add_argument(
+        "--changes",
+        metavar="CHANGE_FILE",
+        help="OSM change file (.osc) to apply to input_file, which must be a "
+        "previously enriched file. Only objects in the change file get all "
+        "features; other objects only have their gender tags re-checked if "
+        "their Wikidata items changed since the last run. Needs the tables "
+        "of etymology_lookup.py, as with --lookup. If output_file is an .osc "
+        "file, an enriched change file is written",
+    )
+    parser.add_argument(
+        "--ways-only",
+        action="store_true",
+        help="Only enrich ways. Nodes are copied unchanged without being "
+        "processed, which is enough for routing",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["full", "osrm"],
+        default="full",
+        help="full: copy the whole file (default). osrm: only write highway "
+        "and route ways, turn restrictions and the nodes they use, for "
+        "osrm-extract",
+    )
+    parser.add_argument(
+        "--lookup",
+        action="store_true",
+        help="Read genders and descriptions from the lookup tables built by "
+        "etymology_lookup.py instead of joining the Wikidata tables",
+    )
     args = parser.parse_args()
+    if args.changes and args.jobs != 1:
+        parser.error("--changes cannot be combined with --jobs")
+    if args.profile == "osrm" and (args.changes or args.jobs != 1):
+        parser.error("--profile osrm cannot be combined with --changes or --jobs")
 
     schema = args.schema
     input_file = args.input_file
@@ -276,13 +1116,22 @@ if __name__ == "__main__":
         )
         sys.exit(1)
 
+    start_reporting("osm_add_tags")
     conn = psycopg2.connect(**db_params)
     with conn.cursor() as cur:
         cur.execute(
             sql.SQL("SET search_path TO {}, public").format(sql.Identifier(schema))
         )
-    if args.feature == "add_gender_tags":
-        run_add_gender_tags(conn, input_file, output_file)
-    elif args.feature == "update_names":
-        run_update_names(conn, input_file, output_file)
+    jobs = args.jobs or os.cpu_count()
+    run_stages(
+        conn,
+        args.feature,
+        input_file,
+        output_file,
+        jobs=jobs,
+        change_file=args.changes,
+        ways_only=args.ways_only,
+        profile=args.profile,
+        lookup=args.lookup,
+    )
     conn.close()
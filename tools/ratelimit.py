@@ -0,0 +1,133 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from metrics import METRICS
+
+
+def parse_retry_after(value, default=None):
+    """Return the number of seconds to wait from a Retry-After header value.
+
+    The header may hold either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RateLimiter:
+    """Token bucket shared by all worker threads of a client.
+
+    acquire() blocks until a request may be sent. The rate adapts to the
+    server: backoff() halves it and pauses every thread (e.g. on HTTP 429),
+    and each success() raises it again by a small step up to max_rate.
+    """
+
+    def __init__(self, max_rate, burst=1, min_rate=0.05, increase=0.05):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updated) * self.rate
+                    )
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def backoff(self, delay):
+        """Halve the rate and pause all requests for delay seconds."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.updated = self.paused_until
+
+
+def is_retryable(status):
+    """Return True for HTTP statuses that ask for the request to be retried."""
+    return status == 429 or status >= 500
+
+
+def request_with_retries(send, url, service, limiter, max_retries, count=None, log=None):
+    """Send a request with send() until the answer is not to be retried.
+
+    send() makes one attempt and returns its requests Response. Connection
+    errors, HTTP 429 and 5xx answers are retried up to max_retries times;
+    each pauses all threads sharing limiter for the Retry-After delay (or
+    an exponential backoff) and lowers its rate. Every attempt is timed
+    under service in the metrics, and count is called with "requests",
+    "retries" and "throttled" (by default, the latter two are counted as
+    http_*_total metrics). log, if given, gets a message for each retry.
+
+    Returns the last response, which is the 429 or 5xx answer if the
+    retries ran out; all other statuses are left to the caller. If the
+    last attempt fails with a requests.RequestException, it is raised.
+    """
+    if count is None:
+
+        def count(key):
+            if key != "requests":
+                METRICS.inc(f"http_{key}_total", service=service)
+
+    for attempt in range(max_retries + 1):
+        if attempt:
+            count("retries")
+        limiter.acquire()
+        count("requests")
+        start = time.perf_counter()
+        try:
+            response = send()
+        except requests.RequestException as e:
+            METRICS.observe_http(service, time.perf_counter() - start, "error")
+            if attempt == max_retries:
+                raise
+            delay = min(60, 2**attempt)
+            if log:
+                log(f"Error requesting {url}: {e}, retrying in {delay:.1f} seconds")
+            limiter.backoff(delay)
+            continue
+        METRICS.observe_http(
+            service, time.perf_counter() - start, response.status_code, len(response.content)
+        )
+        if not is_retryable(response.status_code):
+            if response.status_code < 400:
+                limiter.success()
+            return response
+        count("throttled")
+        if attempt == max_retries:
+            return response
+        delay = parse_retry_after(response.headers.get("Retry-After"), default=min(60, 2**attempt))
+        if log:
+            log(f"HTTP {response.status_code} from {url}, retrying in {delay:.1f} seconds")
+        limiter.backoff(delay)
@@ -0,0 +1,157 @@
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from urllib.parse import quote_plus
+
+import requests
+
+from metrics import METRICS
+from ratelimit import RateLimiter, request_with_retries
+
+WIKIDATA_SPARQL_URL = "https://query.wikidata.org/sparql"
+
+# Longest URL-encoded query to send. Wikidata rejects GET URLs much longer
+# than this, so batches are cut to stay below it.
+MAX_QUERY_LENGTH = 7000
+
+
+class ForbiddenError(Exception):
+    """The endpoint answered HTTP 403; the robot policy says to stop."""
+
+
+def make_batches(
+    items, build_query, max_items=100, max_length=MAX_QUERY_LENGTH, key=None
+):
+    """Split items into batches for build_query.
+
+    build_query takes a list of items and returns the query text. key maps
+    an item to its Wikidata id (default: the item is the id). Each batch has
+    at most max_items items and a URL-encoded query of at most max_length
+    characters.
+    """
+    base_length = len(quote_plus(build_query([])))
+    batch = []
+    length = base_length
+    for item in items:
+        wikidata_id = key(item) if key else item
+        item_length = len(quote_plus(f"wd:{wikidata_id} "))
+        if batch and (len(batch) >= max_items or length + item_length > max_length):
+            yield batch
+            batch = []
+            length = base_length
+        batch.append(item)
+        length += item_length
+    if batch:
+        yield batch
+
+
+class SparqlClient:
+    """Thread-pool SPARQL client with a shared, adaptive rate limit.
+
+    At most concurrency requests are in flight and at most rate requests
+    are started per second. HTTP 429 and 5xx answers are retried after the
+    Retry-After delay (or an exponential backoff) and slow the client down.
+    HTTP 403 raises ForbiddenError so the caller can stop.
+    """
+
+    def __init__(
+        self,
+        user_agent,
+        endpoint_url=WIKIDATA_SPARQL_URL,
+        concurrency=4,
+        rate=2.0,
+        max_retries=5,
+        timeout=60,
+    ):
+        self.endpoint_url = endpoint_url
+        self.headers = {"User-Agent": user_agent}
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.local = threading.local()
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0}
+
+    def _count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+        if key != "requests":
+            METRICS.inc(f"http_{key}_total", service="sparql")
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def query(self, query):
+        """Run one query and return the decoded JSON, or None on failure."""
+
+        def send():
+            return self._session().get(
+                self.endpoint_url,
+                params={"query": query, "format": "json"},
+                headers=self.headers,
+                timeout=self.timeout,
+            )
+
+        try:
+            response = request_with_retries(
+                send,
+                self.endpoint_url,
+                "sparql",
+                self.limiter,
+                self.max_retries,
+                count=self._count,
+                log=logging.warning,
+            )
+        except requests.RequestException as e:
+            logging.error(f"Giving up on query after {self.max_retries} retries: {e}")
+            self._count("failed")
+            return None
+
+        if response.status_code == 403:
+            raise ForbiddenError(
+                "HTTP 403 - access forbidden. Please set a proper User-Agent "
+                "and respect the robot policy: https://w.wiki/4wJS"
+            )
+        if response.status_code != 200:
+            logging.error(
+                f"Error querying {self.endpoint_url}: HTTP {response.status_code} - {response.text}"
+            )
+            self._count("failed")
+            return None
+        if not response.content:
+            logging.error("Empty response from SPARQL endpoint")
+            self._count("failed")
+            return None
+        return response.json()
+
+    def run(self, batches, build_query):
+        """Query all batches concurrently.
+
+        Yields (batch, result) pairs in completion order. result is None
+        for batches that failed. Only concurrency * 2 batches are submitted
+        at a time; the next ones are taken from batches (and their queries
+        built) as results come in. Pending batches are cancelled if the
+        caller stops iterating or a ForbiddenError is raised.
+        """
+        batches = iter(batches)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+
+            def submit(count):
+                for batch in islice(batches, count):
+                    futures[executor.submit(self.query, build_query(batch))] = batch
+
+            futures = {}
+            submit(self.concurrency * 2)
+            try:
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    submit(len(done))
+                    for future in done:
+                        yield futures.pop(future), future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
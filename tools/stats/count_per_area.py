@@ -1,32 +1,148 @@
+import argparse
+import hashlib
 import json
 import csv
+import sqlite3
+import sys
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from metrics import METRICS, start_reporting  # noqa: E402
+from ratelimit import RateLimiter, request_with_retries  # noqa: E402
 
 # Configuration
 INDEX_URL = "https://download.geofabrik.de/index-v1.json"
 TAG_NAME = "name:etymology:wikidata"
+ETYMOLOGY_KEYS = ["name:etymology:wikidata", "name:etymology", "subject:wikidata", "wikidata"]
 OUTPUT_DIR = Path(__file__).parent / "output"
+HTTP_CACHE_DIR = Path(__file__).parent / "cache"
+SERIES_DB = OUTPUT_DIR / "tag_stats.sqlite"
 OUTPUT_DIR.mkdir(exist_ok=True)
 
 
-def fetch_index():
+class HttpClient:
+    """HTTP client with per-host concurrency limits, retries and a cache.
+
+    Responses are stored in cache_dir with their ETag and Last-Modified
+    headers, and sent back as conditional requests next time, so unchanged
+    resources cost an HTTP 304 instead of a full download. Each host gets
+    at most per_host concurrent requests and rate requests per second.
+    Connection errors, HTTP 429 and 5xx answers are retried and slow down
+    all requests to that host.
+    """
+
+    def __init__(self, cache_dir=HTTP_CACHE_DIR, per_host=4, rate=20.0, retries=3, timeout=10):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(exist_ok=True)
+        self.per_host = per_host
+        self.rate = rate
+        self.retries = retries
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.stats = {"requests": 0, "not_modified": 0, "retries": 0, "throttled": 0}
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _host(self, url):
+        """Return the (semaphore, rate limiter) pair of the host of url."""
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = (
+                    threading.BoundedSemaphore(self.per_host),
+                    RateLimiter(self.rate, burst=self.per_host),
+                )
+            return self.hosts[host]
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+        if key != "requests":
+            METRICS.inc(f"http_{key}_total", service="taginfo")
+
+    def _cache_path(self, url):
+        return self.cache_dir / (hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_cache(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(url), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, url, response, data):
+        if not self.cache_dir:
+            return
+        entry = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "data": data,
+        }
+        if not entry["etag"] and not entry["last_modified"]:
+            return
+        path = self._cache_path(url)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        tmp_path.replace(path)
+
+    def get_json(self, url):
+        """Return the decoded JSON at url, using the cache when unchanged."""
+        cached = self._read_cache(url)
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        slots, limiter = self._host(url)
+
+        def send():
+            with slots:
+                return self._session().get(url, headers=headers, timeout=self.timeout)
+
+        response = request_with_retries(
+            send, url, "taginfo", limiter, self.retries, count=self._count
+        )
+        if response.status_code == 304 and cached:
+            self._count("not_modified")
+            METRICS.inc("cache_lookups_total", cache="http", result="hit")
+            return cached["data"]
+        response.raise_for_status()
+        if cached:
+            METRICS.inc("cache_lookups_total", cache="http", result="miss")
+        data = response.json()
+        self._write_cache(url, response, data)
+        return data
+
+
+def fetch_index(client, index_url=INDEX_URL):
     """Fetch the GeoFabrik index."""
-    print(f"Fetching index from {INDEX_URL}...")
-    response = requests.get(INDEX_URL)
-    response.raise_for_status()
-    return response.json()
+    print(f"Fetching index from {index_url}...")
+    return client.get_json(index_url)
 
 
-def fetch_tag_stats(taginfo_url, tag):
+def fetch_tag_stats(client, taginfo_url, tag):
     """Fetch tag statistics for a specific area."""
     url = f"{taginfo_url}/api/4/key/stats?key={tag}"
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        return data
+        return client.get_json(url)
     except Exception as e:
         print(f"  Error fetching {url}: {e}")
         return None
@@ -45,6 +161,7 @@ def extract_stats(stats_data):
     relations_data = data_by_type.get("relations", {})
 
     return {
+        "date": (stats_data.get("data_until") or "")[:10] or None,
         "count": all_data.get("count", 0),
         "nodes": nodes_data.get("count", 0),
         "ways": ways_data.get("count", 0),
@@ -52,14 +169,15 @@ def extract_stats(stats_data):
     }
 
 
-def process_areas(index):
-    """Process all areas and collect statistics."""
+def process_areas(index, client, keys=(TAG_NAME,), workers=16):
+    """Process all areas and collect statistics for each key."""
     results = []
 
     # Extract all areas from the index
     areas = index.get("features", [])
     print(f"Found {len(areas)} areas in the index\n")
 
+    tasks = []
     for idx, feature in enumerate(areas, 1):
         props = feature.get("properties", {})
         area_name = props.get("name", "Unknown")
@@ -74,28 +192,41 @@ def process_areas(index):
             continue
 
         # Remove trailing slash if present
-        taginfo_url = taginfo_url.rstrip("/")
-
-        print(f"[{idx}/{len(areas)}] {area_name}: Fetching statistics...")
-
-        # Fetch statistics
-        stats_data = fetch_tag_stats(taginfo_url, TAG_NAME)
-        stats = extract_stats(stats_data)
-
-        if stats:
-            result = {
-                "area": area_name,
-                "area_id": area_id,
-                "taginfo_url": taginfo_url,
-                "count": stats["count"],
-                "nodes": stats["nodes"],
-                "ways": stats["ways"],
-                "relations": stats["relations"],
-            }
-            results.append(result)
-            print(f"  ✓ Count: {stats['count']}")
-        else:
-            print(f"  ✗ No data available")
+        tasks.append((idx, area_name, area_id, taginfo_url.rstrip("/")))
+
+    # Fetch statistics; the client limits the requests per host
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(fetch_tag_stats, client, taginfo_url, key): (
+                idx,
+                area_name,
+                area_id,
+                taginfo_url,
+                key,
+            )
+            for idx, area_name, area_id, taginfo_url in tasks
+            for key in keys
+        }
+        for future in as_completed(futures):
+            idx, area_name, area_id, taginfo_url, key = futures[future]
+            stats = extract_stats(future.result())
+
+            if stats:
+                result = {
+                    "area": area_name,
+                    "area_id": area_id,
+                    "taginfo_url": taginfo_url,
+                    "tag": key,
+                    "date": stats["date"],
+                    "count": stats["count"],
+                    "nodes": stats["nodes"],
+                    "ways": stats["ways"],
+                    "relations": stats["relations"],
+                }
+                results.append(result)
+                print(f"[{idx}/{len(areas)}] {area_name}: ✓ {key}: {stats['count']}")
+            else:
+                print(f"[{idx}/{len(areas)}] {area_name}: ✗ {key}: No data available")
 
     return results
 
@@ -116,6 +247,8 @@ def save_csv(data, filepath):
         "area",
         "area_id",
         "taginfo_url",
+        "tag",
+        "date",
         "count",
         "nodes",
         "ways",
@@ -128,41 +261,128 @@ def save_csv(data, filepath):
     print(f"Saved CSV to: {filepath}")
 
 
+def open_series(path=SERIES_DB):
+    """Open the time-series database of tag counts, creating it if needed."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tag_counts (
+            area_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            date TEXT NOT NULL,
+            area TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            nodes INTEGER NOT NULL,
+            ways INTEGER NOT NULL,
+            relations INTEGER NOT NULL,
+            fetched_at TEXT NOT NULL,
+            PRIMARY KEY (area_id, tag, date)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS tag_counts_tag_date ON tag_counts (tag, date)")
+    conn.commit()
+    return conn
+
+
+def append_series(conn, results, fetched_at):
+    """Append results to the time series and return the number of new rows.
+
+    Rows are keyed by area, tag and the date of the taginfo data (or the
+    fetch date if taginfo does not report it). Counts already stored for a
+    date are kept, so the series is append-only and reruns are harmless.
+    """
+    before = conn.total_changes
+    with conn:
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO tag_counts
+            VALUES (:area_id, :tag, :date, :area, :count, :nodes, :ways, :relations, :fetched_at)
+            """,
+            (
+                {**r, "date": r["date"] or fetched_at[:10], "fetched_at": fetched_at}
+                for r in results
+            ),
+        )
+    return conn.total_changes - before
+
+
 def main():
     """Main function."""
-    print(f"Fetching statistics for tag: {TAG_NAME}\n")
+    parser = argparse.ArgumentParser(description="Count tags per GeoFabrik area using taginfo.")
+    parser.add_argument(
+        "--key",
+        dest="keys",
+        action="append",
+        help=f"Tag key to count, may be repeated (default: {TAG_NAME})",
+    )
+    parser.add_argument(
+        "--etymology-keys",
+        action="store_true",
+        help="Count all of " + ", ".join(ETYMOLOGY_KEYS),
+    )
+    parser.add_argument("--db", default=SERIES_DB, help="Time-series database (default: %(default)s)")
+    parser.add_argument("--snapshot", action="store_true", help="Also write timestamped JSON and CSV files")
+    parser.add_argument("--index-url", default=INDEX_URL, help="GeoFabrik index URL (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent requests (default: %(default)s)")
+    parser.add_argument("--per-host", type=int, default=4, help="Concurrent requests per host (default: %(default)s)")
+    parser.add_argument(
+        "--rate", type=float, default=20.0, help="Requests per second per host (default: %(default)s)"
+    )
+    parser.add_argument("--retries", type=int, default=3, help="Retries per request (default: %(default)s)")
+    parser.add_argument("--no-http-cache", action="store_true", help="Always download everything")
+    args = parser.parse_args()
+    start_reporting("count_per_area")
+    keys = list(dict.fromkeys((args.keys or []) + (ETYMOLOGY_KEYS if args.etymology_keys else [])))
+    keys = keys or [TAG_NAME]
+
+    client = HttpClient(
+        cache_dir=None if args.no_http_cache else HTTP_CACHE_DIR,
+        per_host=args.per_host,
+        rate=args.rate,
+        retries=args.retries,
+    )
+    print(f"Fetching statistics for tags: {', '.join(keys)}\n")
 
     try:
         # Fetch index
-        index = fetch_index()
+        index = fetch_index(client, args.index_url)
 
         # Process all areas
-        results = process_areas(index)
+        started = time.monotonic()
+        results = process_areas(index, client, keys=keys, workers=args.workers)
+        print(
+            f"\nFetched {client.stats['requests']} URLs in {time.monotonic() - started:.1f} seconds "
+            f"({client.stats['not_modified']} not modified, {client.stats['retries']} retries)"
+        )
 
         # Sort by count (descending)
         results.sort(key=lambda x: x["count"], reverse=True)
 
-        # Generate filenames with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        json_file = (
-            OUTPUT_DIR / f"tag_stats_{TAG_NAME.replace(':', '_')}_{timestamp}.json"
-        )
-        csv_file = (
-            OUTPUT_DIR / f"tag_stats_{TAG_NAME.replace(':', '_')}_{timestamp}.csv"
-        )
+        # Store results
+        fetched_at = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        conn = open_series(args.db)
+        added = append_series(conn, results, fetched_at)
+        conn.close()
+        print(f"\nAdded {added} rows to: {args.db}")
 
-        # Save results
-        save_json(results, json_file)
-        save_csv(results, csv_file)
+        if args.snapshot:
+            # Generate filenames with timestamp
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            name = "_".join(key.replace(":", "_") for key in keys)
+            save_json(results, OUTPUT_DIR / f"tag_stats_{name}_{timestamp}.json")
+            save_csv(results, OUTPUT_DIR / f"tag_stats_{name}_{timestamp}.csv")
 
         # Print summary
-        total_count = sum(r["count"] for r in results)
-        print(f"\nSummary:")
-        print(f"  Total areas processed: {len(results)}")
-        print(f"  Total occurrences: {total_count}")
-        print(f"\nTop 10 areas:")
-        for idx, result in enumerate(results[:10], 1):
-            print(f"  {idx}. {result['area']}: {result['count']}")
+        for key in keys:
+            key_results = [r for r in results if r["tag"] == key]
+            total_count = sum(r["count"] for r in key_results)
+            print(f"\nSummary for {key}:")
+            print(f"  Total areas processed: {len(key_results)}")
+            print(f"  Total occurrences: {total_count}")
+            print(f"\nTop 10 areas:")
+            for idx, result in enumerate(key_results[:10], 1):
+                print(f"  {idx}. {result['area']}: {result['count']}")
 
     except Exception as e:
         print(f"Error: {e}")
@@ -0,0 +1,85 @@
+import sqlite3
+import time
+
+from metrics import METRICS
+
+
+class NamedAfterCache:
+    """Persistent per-QID cache of Wikidata 'named after' (P138) results.
+
+    Every queried QID gets a row, including QIDs without P138 (stored with
+    empty ids), so they are not queried again until their row is older than
+    the TTL. Rows are written per batch, so an interrupted run keeps what it
+    has fetched.
+    """
+
+    def __init__(self, path):
+        # Regions running side by side share the cache, so wait for locks
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS named_after (
+                qid TEXT PRIMARY KEY,
+                ids TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM named_after").fetchone()[0]
+
+    def stale(self, qids, ttl):
+        """Return the QIDs from qids that are missing or older than ttl seconds."""
+        cutoff = time.time() - ttl
+        fresh = {
+            qid
+            for (qid,) in self.conn.execute(
+                "SELECT qid FROM named_after WHERE fetched_at >= ?", (cutoff,)
+            )
+        }
+        stale = [qid for qid in qids if qid not in fresh]
+        METRICS.inc("cache_lookups_total", len(qids) - len(stale), cache="named_after", result="hit")
+        METRICS.inc("cache_lookups_total", len(stale), cache="named_after", result="miss")
+        return stale
+
+    def store(self, qids, named_after, fetched_at=None):
+        """Store the results of one batch.
+
+        named_after maps QID -> {named after QID: label}. QIDs in qids that
+        are missing from named_after are stored as having no P138.
+        """
+        fetched_at = fetched_at or time.time()
+        rows = []
+        for qid in qids:
+            values = named_after.get(qid, {})
+            rows.append((qid, ";".join(values), ";".join(values.values()), fetched_at))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO named_after VALUES (?, ?, ?, ?)", rows
+            )
+
+    def import_results(self, results, fetched_at):
+        """Import {qid: {"ids": ..., "labels": ...}} from the old JSON cache."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO named_after VALUES (?, ?, ?, ?)",
+                (
+                    (qid, value["ids"], value["labels"], fetched_at)
+                    for qid, value in results.items()
+                ),
+            )
+
+    def results(self):
+        """Return {qid: {"ids": ..., "labels": ...}} for QIDs with P138."""
+        return {
+            qid: {"ids": ids, "labels": labels}
+            for qid, ids, labels in self.conn.execute(
+                "SELECT qid, ids, labels FROM named_after WHERE ids != ''"
+            )
+        }
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,103 @@
+import bz2
+import gzip
+import json
+import logging
+import re
+import sys
+
+from metrics import METRICS
+
+# The entity id is the first "id" key on each line of a Wikidata JSON dump
+ID_PATTERN = re.compile(rb'"id":"([QPL][0-9]+)"')
+
+
+def open_dump(path):
+    """Open a line-delimited Wikidata JSON dump (.json, .json.gz, .json.bz2).
+
+    Use "-" to read an uncompressed dump from stdin, e.g. piped from a
+    parallel decompressor such as pigz or lbzip2.
+    """
+    if path == "-":
+        return sys.stdin.buffer
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def iter_entities(path, ids):
+    """Yield the parsed entities from the dump whose id is in ids.
+
+    Only the id of each line is matched before decoding, so lines for other
+    entities cost a regex search rather than a JSON parse.
+    """
+    with open_dump(path) as f:
+        read = 0
+        for line_number, line in enumerate(f, 1):
+            read += len(line)
+            if line_number % 100000 == 0:
+                METRICS.inc("input_bytes_total", read, source="wikidata_dump")
+                read = 0
+            if line_number % 1000000 == 0:
+                logging.info(f"Read {line_number} lines of Wikidata dump.")
+            match = ID_PATTERN.search(line, 0, 200)
+            if not match or match.group(1).decode("ascii") not in ids:
+                continue
+            line = line.rstrip().rstrip(b",")
+            METRICS.inc("wikidata_entities_total")
+            yield json.loads(line)
+        METRICS.inc("input_bytes_total", read, source="wikidata_dump")
+
+
+def truthy_values(entity, prop):
+    """Return the item ids of the best-ranked statements of prop, like wdt:."""
+    statements = entity.get("claims", {}).get(prop, [])
+    preferred = [s for s in statements if s.get("rank") == "preferred"]
+    values = []
+    for statement in preferred or statements:
+        if statement.get("rank") == "deprecated":
+            continue
+        value = statement["mainsnak"].get("datavalue", {}).get("value")
+        if isinstance(value, dict) and "id" in value:
+            values.append(value["id"])
+    return values
+
+
+def label(entity, languages):
+    labels = entity.get("labels", {})
+    for language in languages:
+        if language in labels:
+            return labels[language]["value"]
+    return None
+
+
+def named_after_from_dump(path, qids, languages=("da", "en"), resolve_labels=True):
+    """Look up 'named after' (P138) for qids in a local Wikidata dump.
+
+    Returns {qid: {named after QID: label}} for the qids that have P138,
+    the same shape as parsed SPARQL results. Labels of the named-after
+    items come from a second pass over the dump, unless they were seen in
+    the first one or resolve_labels is False; missing labels fall back to
+    the QID, like the SPARQL label service does.
+    """
+    qids = set(qids)
+    targets = {}
+    labels = {}
+    for entity in iter_entities(path, qids):
+        labels[entity["id"]] = label(entity, languages)
+        values = truthy_values(entity, "P138")
+        if values:
+            targets[entity["id"]] = values
+    logging.info(f"Found P138 for {len(targets)} of {len(qids)} items in dump.")
+
+    missing = {t for values in targets.values() for t in values if t not in labels}
+    if missing and resolve_labels and path != "-":
+        logging.info(f"Reading dump again for {len(missing)} labels.")
+        for entity in iter_entities(path, missing):
+            labels[entity["id"]] = label(entity, languages)
+
+    return {
+        qid: {target: labels.get(target) or target for target in values}
+        for qid, values in targets.items()
+    }
@@ -1,60 +1,111 @@
 import osmium
-import requests
+import argparse
 import csv
 import logging
 import json
 import os
-import time
+import re
 
-osmFile = "denmark-latest.osm.pbf"
-# osmFile = 'andorra-latest.osm.pbf'
+import etymology_candidates
+from metrics import FLUSH_EVERY, METRICS, start_reporting
+from sparql_client import (
+    WIKIDATA_SPARQL_URL,
+    ForbiddenError,
+    SparqlClient,
+    make_batches,
+)
+from wikidata_cache import NamedAfterCache
+from wikidata_dump import named_after_from_dump
 
 # Enable logging for debugging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# User-Agent for Wikidata requests (set to identify your bot and include contact info if possible)
+USER_AGENT = "FindvejEtymologyBot/1.0 (https://navne.findvej.dk/;peter@ter.dk)"
+
+STAGES = ["scan", "query", "write"]
+
+# Condition on the shared candidates file matching OSMHandler
+CANDIDATES_WHERE = "wikidata IS NOT NULL AND name_etymology_wikidata IS NULL"
+
 
 # Step 1: Fetch OSM objects with 'wikidata' key but without 'name:etymology:wikidata'
 class OSMHandler(osmium.SimpleHandler):
-    def __init__(self, max_elements=None):
+    """Write candidate elements to a tab-separated file as they are found.
+
+    Each row holds type, id, wikidata and name, so the scan keeps no
+    elements in memory. Read the file back with iter_candidates.
+    """
+
+    def __init__(self, output, max_elements=None):
         osmium.SimpleHandler.__init__(self)
-        self.elements = []
+        self.writer = csv.writer(output, delimiter="\t", lineterminator="\n")
+        self.count = 0
         self.max_elements = max_elements
         self.reached_max = False
+        self.seen = {"node": 0, "way": 0, "relation": 0}
+
+    def count_seen(self, elem_type):
+        self.seen[elem_type] += 1
+        if self.seen[elem_type] == FLUSH_EVERY:
+            self.flush_counts()
+
+    def flush_counts(self):
+        for elem_type, seen in self.seen.items():
+            METRICS.inc("osm_objects_total", seen, source="wikidata_scan", type=elem_type)
+            self.seen[elem_type] = 0
 
     def add_element(self, elem, elem_type):
-        if self.max_elements is not None and len(self.elements) >= self.max_elements:
+        if self.max_elements is not None and self.count >= self.max_elements:
             self.reached_max = True
             return
         tags = elem.tags
         if "wikidata" in tags and "name:etymology:wikidata" not in tags:
-            element = {"id": elem.id, "type": elem_type, "wikidata": tags["wikidata"]}
-            if "name" in tags:
-                element["name"] = tags["name"]
-            self.elements.append(element)
-            if len(self.elements) % 100 == 0:
-                logging.info(f"Added {len(self.elements)} elements so far.")
+            self.writer.writerow(
+                [elem_type, elem.id, tags["wikidata"], tags.get("name", "")]
+            )
+            self.count += 1
+            METRICS.inc("candidates_total", source="wikidata_scan")
+            if self.count % 100 == 0:
+                logging.info(f"Added {self.count} elements so far.")
             logging.debug(
                 f"Added {elem_type} with ID {elem.id} and Wikidata ID {tags['wikidata']}"
             )
 
     def node(self, n):
         if not self.reached_max:
+            self.count_seen("node")
             self.add_element(n, "node")
 
     def way(self, w):
         if not self.reached_max:
+            self.count_seen("way")
             self.add_element(w, "way")
 
     def relation(self, r):
         if not self.reached_max:
+            self.count_seen("relation")
             self.add_element(r, "relation")
 
 
+def iter_candidates(filename):
+    """Lazily yield the candidate elements written by OSMHandler."""
+    with open(filename, "r", newline="", encoding="utf-8") as f:
+        for elem_type, elem_id, wikidata, name in csv.reader(f, delimiter="\t"):
+            element = {"id": int(elem_id), "type": elem_type, "wikidata": wikidata}
+            if name:
+                element["name"] = name
+            yield element
+
+
 def cache_result_to_file(result, filename):
-    with open(filename, "w", encoding="utf-8") as f:
+    """Write result as JSON, replacing filename only once it is complete."""
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w", encoding="utf-8") as f:
         json.dump(result, f)
+    os.replace(tmp_filename, filename)
 
 
 def read_cache_from_file(filename):
@@ -64,27 +115,75 @@ def read_cache_from_file(filename):
     return None
 
 
-# User-Agent for Wikidata requests (set to identify your bot and include contact info if possible)
-USER_AGENT = "FindvejEtymologyBot/1.0 (https://navne.findvej.dk/;peter@ter.dk)"
+def input_signature(osm_file, max_elements):
+    """Identify an input file, so checkpoints of a changed file are not reused."""
+    stat = os.stat(osm_file)
+    return {
+        "input": os.path.abspath(osm_file),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "max_elements": max_elements,
+    }
+
+
+def checkpoint_files(work_dir, region):
+    """Return the checkpoint and output file names for a region."""
+    prefix = os.path.join(work_dir, region)
+    return {
+        "scan_manifest": f"{prefix}.scan.json",
+        "candidates": f"{prefix}.candidates.tsv",
+        "csv": f"{prefix}.osm_etymology_data.csv",
+        "objects": f"{prefix}.objects.txt",
+    }
+
+
+def stage_scan(osm_file, files, max_elements=None, candidates=None):
+    """Write candidate elements of osm_file to the candidates checkpoint.
+
+    With candidates (a file from etymology_candidates.py), the elements are
+    read from it instead of decoding osm_file. A checkpoint from the same
+    input file is reused.
+    """
+    signature = input_signature(candidates or osm_file, max_elements)
+    if read_cache_from_file(files["scan_manifest"]) == signature and os.path.exists(
+        files["candidates"]
+    ):
+        logging.info(f"Using candidates from {files['candidates']}.")
+        return
+
+    tmp_filename = f"{files['candidates']}.tmp"
+    with open(tmp_filename, "w", newline="", encoding="utf-8") as f:
+        if candidates:
+            logging.info(f"Reading candidates from {candidates}...")
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            count = 0
+            for elem in etymology_candidates.iter_candidates(
+                candidates, CANDIDATES_WHERE, limit=max_elements
+            ):
+                writer.writerow(
+                    [elem["type"], elem["id"], elem["wikidata"], elem["name"] or ""]
+                )
+                count += 1
+        else:
+            handler = OSMHandler(f, max_elements=max_elements)
+            logging.info(f"Starting to apply OSM file {osm_file}...")
+            handler.apply_file(osm_file)
+            handler.flush_counts()
+            METRICS.inc("input_bytes_total", os.path.getsize(osm_file), source="wikidata_scan")
+            count = handler.count
+    os.replace(tmp_filename, files["candidates"])
+    logging.info(f"Finished scan. Found {count} elements.")
+    cache_result_to_file(signature, files["scan_manifest"])
+
+
+def check_candidates(files):
+    if not os.path.exists(files["candidates"]):
+        raise SystemExit(
+            f"No scan checkpoint {files['candidates']} found; run the scan stage first."
+        )
 
-# Step 1: Read from cache or process OSM file
-cache_file_step1 = "cache_osm_candidates.json"
-cached_elements = read_cache_from_file(cache_file_step1)
-max_elements = None  # Set the max limit for elements
-
-if cached_elements:
-    logging.info(f"Loaded {len(cached_elements)} elements from cache.")
-    handler = OSMHandler(max_elements=max_elements)
-    handler.elements = cached_elements
-else:
-    handler = OSMHandler(max_elements=max_elements)
-    logging.info("Starting to apply OSM file...")
-    handler.apply_file(osmFile)
-    logging.info(f"Finished applying OSM file. Found {len(handler.elements)} elements.")
-    cache_result_to_file(handler.elements, cache_file_step1)
 
 # Step 2: Ask Wikidata for 'named after' (P138)
-endpoint_url = "https://query.wikidata.org/sparql"
 query_template = """
 SELECT ?item ?namedAfter ?namedAfterLabel WHERE {{
   VALUES ?item {{ {wikidata_ids} }}
@@ -93,143 +192,230 @@ SELECT ?item ?namedAfter ?namedAfterLabel WHERE {{
 }}
 """
 
-wikidata_results = {}
-cache_file_step2 = "cache_wikidata_named_after.json"
-cached_results = read_cache_from_file(cache_file_step2)
-
-if cached_results:
-    logging.info("Loaded results from cache.")
-    wikidata_results = cached_results
-
-# Filter out elements with already queried Wikidata IDs
-elements_to_query = [
-    elem for elem in handler.elements if elem["wikidata"] not in wikidata_results
-]
-
-if not cached_results:
-    batch_size = 100
-    for i in range(0, len(elements_to_query), batch_size):
-        batch = elements_to_query[i : i + batch_size]
-        wikidata_ids = " ".join(f"wd:{elem['wikidata']}" for elem in batch)
-        query = query_template.format(wikidata_ids=wikidata_ids)
-        if i % 1000 == 0:
-            logging.info(f"Querying Wikidata for {i} items so far.")
-        logging.debug(f"Querying Wikidata for batch {i // batch_size + 1}...")
-        headers = {"User-Agent": USER_AGENT}
-        try:
-            response = requests.get(
-                endpoint_url,
-                params={"query": query, "format": "json"},
-                headers=headers,
-                timeout=30,
-            )
-        except requests.RequestException as e:
-            logging.error(
-                f"Request error querying Wikidata for batch {i // batch_size + 1}: {e}"
-            )
-            data = {"results": {"bindings": []}}
-            time.sleep(5)
+
+def build_query(batch):
+    wikidata_ids = " ".join(f"wd:{wikidata_id}" for wikidata_id in batch)
+    return query_template.format(wikidata_ids=wikidata_ids)
+
+
+def parse_named_after(data):
+    """Group SPARQL bindings by exact item QID in a single pass.
+
+    Returns a dict of item QID -> {named after QID: label}.
+    """
+    named_after = {}
+    for result in data["results"]["bindings"]:
+        if "namedAfter" not in result:
             continue
+        wikidata_id = result["item"]["value"].rsplit("/", 1)[-1]
+        named_after_id = result["namedAfter"]["value"].rsplit("/", 1)[-1]
+        label = result.get("namedAfterLabel", {}).get("value", named_after_id)
+        named_after.setdefault(wikidata_id, {})[named_after_id] = label
+    return named_after
 
-        # Respect Wikidata robot policy: stop if access is forbidden (403)
-        if response.status_code == 403:
-            logging.error(
-                f"Error querying Wikidata: HTTP 403 - access forbidden.\n"
-                "Please set a proper User-Agent and respect the robot policy: https://w.wiki/4wJS"
-            )
-            # Stop further queries to avoid hammering the service; save what we have and break out
-            stop_querying = True
-            data = {"results": {"bindings": []}}
-        elif response.status_code == 200:
-            if response.content:
-                data = response.json()
-            else:
-                logging.error(f"Empty response for batch {i // batch_size + 1}")
-                data = {"results": {"bindings": []}}
-        else:
-            logging.error(
-                f"Error querying Wikidata: HTTP {response.status_code} - {response.text}"
-            )
-            data = {"results": {"bindings": []}}
 
-        for elem in batch:
-            wikidata_id = elem["wikidata"]
-            named_after_ids = set()
-            named_after_labels = {}
-            for result in data["results"]["bindings"]:
-                if result["item"]["value"].endswith(wikidata_id):
-                    if "namedAfter" in result:
-                        named_after_url = result["namedAfter"]["value"]
-                        named_after_id = named_after_url.split("/")[-1]
-                        named_after_ids.add(named_after_id)
-                        if "namedAfterLabel" in result:
-                            named_after_labels[named_after_id] = result[
-                                "namedAfterLabel"
-                            ]["value"]
-            if named_after_ids:
-                wikidata_results[wikidata_id] = {
-                    "ids": ";".join(named_after_ids),
-                    "labels": ";".join(
-                        named_after_labels[named_after_id]
-                        for named_after_id in named_after_ids
-                    ),
-                }
+def open_cache(cache_file, legacy_cache_file="cache_wikidata_named_after.json"):
+    cache = NamedAfterCache(cache_file)
+    if not len(cache) and os.path.exists(legacy_cache_file):
+        legacy_results = read_cache_from_file(legacy_cache_file)
+        cache.import_results(
+            legacy_results, fetched_at=os.path.getmtime(legacy_cache_file)
+        )
+        logging.info(f"Imported {len(legacy_results)} results from {legacy_cache_file}.")
+    return cache
+
+
+def stage_query(files, cache, args):
+    """Fetch P138 for every missing or stale QID into the per-QID cache.
+
+    The cache is written per batch, so this stage resumes where it stopped.
+    """
+    # Query each valid Wikidata ID once, however many elements share it
+    qid_pattern = re.compile(r"^Q[0-9]+$")
+    unique_ids = dict.fromkeys(
+        elem["wikidata"]
+        for elem in iter_candidates(files["candidates"])
+        if qid_pattern.match(elem["wikidata"])
+    )
+    ids_to_query = cache.stale(unique_ids, ttl=args.cache_ttl_days * 86400)
+    logging.info(
+        f"{len(ids_to_query)} of {len(unique_ids)} unique Wikidata IDs to query."
+    )
+    if not ids_to_query:
+        return
+
+    if args.dump:
+        logging.info(f"Reading named after (P138) from {args.dump}.")
+        cache.store(ids_to_query, named_after_from_dump(args.dump, ids_to_query))
+        return
+
+    client = SparqlClient(
+        USER_AGENT,
+        endpoint_url=args.endpoint,
+        concurrency=args.concurrency,
+        rate=args.rate,
+    )
+    batches = make_batches(ids_to_query, build_query)
+    try:
+        for batch_number, (batch, data) in enumerate(
+            client.run(batches, build_query), 1
+        ):
+            if batch_number % 10 == 0:
+                logging.info(f"Queried Wikidata for {batch_number} batches so far.")
+            if data is None:
+                continue
+            named_after = parse_named_after(data)
+            cache.store(batch, named_after)
+            for wikidata_id, values in named_after.items():
                 logging.debug(
-                    f"Processed Wikidata ID {wikidata_id} with namedAfter IDs {wikidata_results[wikidata_id]['ids']} and labels {wikidata_results[wikidata_id]['labels']}"
+                    f"Processed Wikidata ID {wikidata_id} with namedAfter IDs {';'.join(values)} and labels {';'.join(values.values())}"
                 )
-        time.sleep(1)  # To avoid hitting rate limits
-
-        if "stop_querying" in locals() and stop_querying:
-            logging.info("Stopping further Wikidata queries due to HTTP 403 response.")
-            break
+    except ForbiddenError as e:
+        # Respect Wikidata robot policy: stop querying, but keep what we have
+        logging.error(f"Error querying Wikidata: {e}")
+        logging.info("Stopping further Wikidata queries due to HTTP 403 response.")
+    logging.info(f"Wikidata request statistics: {client.stats}")
 
-    cache_result_to_file(wikidata_results, cache_file_step2)
 
 # Step 3: Combine results and write output to CSV file
-output_rows = [
-    [
-        "OSM_ID",
-        "OSM_Type",
-        "OSM_Link",
-        "Wikidata_ID",
-        "NamedAfter_ID",
-        "NamedAfter_Label",
-        "Name",
-    ]
-]
-object_lines = []  # To store objects for objects.txt
-
-for elem in handler.elements:
-    wikidata_id = elem["wikidata"]
-    if wikidata_id in wikidata_results:
-        named_after_ids = wikidata_results[wikidata_id]["ids"]
-        named_after_labels = wikidata_results[wikidata_id]["labels"]
-        osm_link = f"https://www.openstreetmap.org/{elem['type']}/{elem['id']}"
-        name = elem.get("name", "")
-        output_rows.append(
+def stage_write(files, wikidata_results):
+    """Stream the candidates with P138 to the CSV and objects.txt outputs."""
+    object_prefixes = {"node": "n", "way": "w", "relation": "r"}
+    csv_tmp = f"{files['csv']}.tmp"
+    objects_tmp = f"{files['objects']}.tmp"
+    with open(csv_tmp, "w", newline="", encoding="utf-8") as csv_file, open(
+        objects_tmp, "w", encoding="utf-8"
+    ) as objects_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(
             [
-                elem["id"],
-                elem["type"],
-                osm_link,
-                wikidata_id,
-                named_after_ids,
-                named_after_labels,
-                name,
+                "OSM_ID",
+                "OSM_Type",
+                "OSM_Link",
+                "Wikidata_ID",
+                "NamedAfter_ID",
+                "NamedAfter_Label",
+                "Name",
             ]
         )
+        separator = ""
+        for elem in iter_candidates(files["candidates"]):
+            wikidata_id = elem["wikidata"]
+            if wikidata_id not in wikidata_results:
+                continue
+            osm_link = f"https://www.openstreetmap.org/{elem['type']}/{elem['id']}"
+            writer.writerow(
+                [
+                    elem["id"],
+                    elem["type"],
+                    osm_link,
+                    wikidata_id,
+                    wikidata_results[wikidata_id]["ids"],
+                    wikidata_results[wikidata_id]["labels"],
+                    elem.get("name", ""),
+                ]
+            )
+
+            # objects.txt is a single comma-separated line
+            object_prefix = object_prefixes.get(elem["type"], "")
+            if object_prefix:
+                objects_file.write(f"{separator}{object_prefix}{elem['id']}")
+                separator = ","
+    os.replace(csv_tmp, files["csv"])
+    logging.info(f"Finished writing output to {files['csv']}")
+    os.replace(objects_tmp, files["objects"])
+    logging.info(f"Finished writing output to {files['objects']}")
+
+
+def default_region(osm_file):
+    name = os.path.basename(osm_file)
+    for suffix in (".osm.pbf", ".pbf", ".osm.bz2", ".osm"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find OSM objects whose wikidata item has 'named after' (P138)."
+    )
+    parser.add_argument("osm_file", help="Input OSM or PBF file")
+    parser.add_argument(
+        "--stage",
+        action="append",
+        choices=STAGES,
+        help="Stage to run: scan, query or write. May be repeated "
+        "(default: all stages in order)",
+    )
+    parser.add_argument(
+        "--region",
+        help="Name for checkpoint and output files (default: input file name)",
+    )
+    parser.add_argument(
+        "--work-dir", default=".", help="Directory for checkpoint and output files"
+    )
+    parser.add_argument(
+        "--cache-file",
+        default="cache_wikidata_named_after.sqlite",
+        help="Per-QID Wikidata cache, shared between regions",
+    )
+    parser.add_argument(
+        "--cache-ttl-days",
+        type=float,
+        default=30,
+        help="Query cached QIDs again after this many days (default: 30)",
+    )
+    parser.add_argument(
+        "--max-elements", type=int, help="Stop scanning after this many elements"
+    )
+    parser.add_argument(
+        "--candidates",
+        help="Read elements from a candidates file made by etymology_candidates.py "
+        "instead of scanning osm_file",
+    )
+    parser.add_argument(
+        "--endpoint",
+        default=os.environ.get("WIKIDATA_SPARQL_URL", WIKIDATA_SPARQL_URL),
+        help="SPARQL endpoint, e.g. a local fake endpoint from "
+        "tools/mock/sparql_endpoint.py",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Parallel SPARQL requests (Wikidata allows at most 5 per client)",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=2.0, help="Max SPARQL requests started per second"
+    )
+    parser.add_argument(
+        "--dump",
+        default=os.environ.get("WIKIDATA_DUMP"),
+        help="Local Wikidata JSON dump (.json.gz/.json.bz2) to read instead of "
+        "querying SPARQL",
+    )
+    args = parser.parse_args()
+
+    start_reporting("wikidata_etymology_to_osm")
+    stages = [stage for stage in STAGES if stage in (args.stage or STAGES)]
+    region = args.region or default_region(args.osm_file)
+    os.makedirs(args.work_dir, exist_ok=True)
+    files = checkpoint_files(args.work_dir, region)
+
+    if "scan" in stages:
+        stage_scan(args.osm_file, files, args.max_elements, args.candidates)
+    else:
+        check_candidates(files)
+
+    cache = open_cache(args.cache_file)
+    try:
+        if "query" in stages:
+            stage_query(files, cache, args)
+        if "write" in stages:
+            stage_write(files, cache.results())
+    finally:
+        cache.close()
+
 
-        # Add object to the list for objects.txt
-        object_prefix = {"node": "n", "way": "w", "relation": "r"}.get(elem["type"], "")
-        if object_prefix:
-            object_lines.append(f"{object_prefix}{elem['id']}")
-
-# Write output to CSV file
-with open("osm_etymology_data.csv", "w", newline="", encoding="utf-8") as f:
-    writer = csv.writer(f)
-    writer.writerows(output_rows)
-logging.info("Finished writing output to osm_etymology_data.csv")
-
-# Write objects to objects.txt
-with open("objects.txt", "w", encoding="utf-8") as f:
-    f.write(",".join(object_lines))
-logging.info("Finished writing output to objects.txt")
+if __name__ == "__main__":
+    main()